@@ -82,6 +82,8 @@ def run(agents,sop,environment):
             os.environ.clear()
             break
         action = current_agent.step(current_state,True)   #component_dict = current_state[self.role[current_node.name]]   current_agent.compile(component_dict) 
+        # predict the next state and role once the response has streamed if "speculative" is set in the SOP
+        sop.speculate(action,environment)
         gradio_process(action,current_state)
         memory = process(action)
         environment.update_memory(memory,current_state)
@@ -106,6 +106,8 @@ def run(agents,sop,environment):
             break
         block_when_next(current_agent, current_state)
         action = current_agent.step(current_state)   #component_dict = current_state[self.role[current_node.name]]   current_agent.compile(component_dict) 
+        # predict the next state and role once the response has streamed if "speculative" is set in the SOP
+        sop.speculate(action,environment)
         gradio_process(action,current_state)
         memory = process(action)
         environment.update_memory(memory,current_state)
@@ -32,6 +32,8 @@ def run(agents,sop,environment):
         user_input = input(f"{current_agent.name}:") if current_agent.is_user else ""
         
         action = current_agent.step(current_state,user_input)   #component_dict = current_state[self.role[current_node.name]]   current_agent.compile(component_dict) 
+        # predict the next state and role once the response has streamed if "speculative" is set in the SOP
+        sop.speculate(action,environment)
         memory = action.process()
         environment.update_memory(memory,current_state)
         
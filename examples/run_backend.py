@@ -35,6 +35,9 @@ from agents.SOP import SOP
 from agents.Agent import Agent
 from agents.Environment import Environment
 from agents.Memory import Memory
+# the modules under src/agents import the top-level utils, warm up that one
+from utils import warmup
+from transport import aclose_session
 
 # -*- coding: utf-8 -*-
 
@@ -62,6 +65,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+
+# 关闭服务时释放连接池
+# release the pooled connections on shutdown
+@app.on_event("shutdown")
+async def shutdown():
+    await aclose_session()
+
 # 路由设置
 
 headers = {
@@ -78,9 +89,18 @@ async def ping():
    }
 
 
+async def iterate_response(response):
+    if hasattr(response, "__aiter__"):
+        async for chat_answer in response:
+            yield chat_answer
+    else:
+        for chat_answer in response:
+            yield chat_answer
+
+
 async def generate_events(response):
     msg=""
-    for chat_answer in response:
+    async for chat_answer in iterate_response(response):
         if chat_answer:
             msg+=chat_answer
             if chat_answer:
@@ -126,13 +146,15 @@ async def reply(request:Request):
     userRole = data.get('userRole')
     query = data.get('query')
     memory = Memory(userRole, userName, query)
-    environment.update_memory(memory,sop.current_state)
+    await environment.aupdate_memory(memory,sop.current_state)
     environment.current_state.index = 1
     
-    current_state,current_agent= sop.next(environment,agents)
-    action = current_agent.step(current_state)   #component_dict = current_state[self.role[current_node.name]]   current_agent.compile(component_dict) 
-    memory = action.process()
-    environment.update_memory(memory,current_state)
+    current_state,current_agent= await sop.anext(environment,agents)
+    action = await current_agent.astep(current_state)   #component_dict = current_state[self.role[current_node.name]]   current_agent.compile(component_dict) 
+    # predict the next state and role once the response has streamed if "speculative" is set in the SOP
+    sop.aspeculate(action,environment)
+    memory = await action.aprocess()
+    await environment.aupdate_memory(memory,current_state)
     
     response = action.response
 
@@ -145,6 +167,9 @@ async def reply(request:Request):
 
 
 if __name__ == '__main__':
+    # 在开始服务前加载向量模型
+    # Load the embedding model before serving
+    warmup()
     uvicorn.run('serving:app', host=addr, port=args.port, reload=False)
 
 
@@ -20,19 +20,42 @@ class Action:
         processing action
         Rerutn : memory(Memory)
         """
-        response = self.response
-        send_name = self.name
-        send_role = self.role
         all = ""
-        for res in response:
+        for res in self.response:
             all += res
-        parse = f"{send_name}:"
+        return self._get_memory(all)
+
+    async def aprocess(self):
+        """
+        async version of process, the response can be an async generator or a normal iterable
+        Rerutn : memory(Memory)
+        """
+        all = ""
+        if hasattr(self.response, "__aiter__"):
+            async for res in self.response:
+                all += res
+        else:
+            for res in self.response:
+                all += res
+        return self._get_memory(all)
+
+    def strip_name(self, all):
+        """
+        Return the response without the leading "name:" the agent may speak in the third person
+        """
+        parse = f"{self.name}:"
         
         # 将里面对话的第三人称删了
         # The third person in the dialogue was deleted.
         while parse in all:
             index = all.index(parse) + len(parse)
             all = all[index:]
+        return all
+
+    def _get_memory(self, all):
+        send_name = self.name
+        send_role = self.role
+        all = self.strip_name(all)
         
         if not self.is_user:
             print(f"{send_name}({send_role}):{all}")
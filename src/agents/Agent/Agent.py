@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """LLM autonoumous agent"""
+import asyncio
 from LLM.base_LLM import *
 from Component import *
 from Action import Action
@@ -99,22 +100,39 @@ class Agent:
         assert len(config["agents"].keys()) != 2 or (roles_to_names[config["root"]][config["states"][config["root"]]["begin_role"]] not in user_names and "begin_query"  in config["states"][config["root"]]),"In a single-agent scenario, there must be an opening statement and it must be the agent" 
         return agents, roles_to_names, names_to_roles
 
-    def step(self, current_state,input=""):
-        """
-        return actions by current state and environment
-        Return: action(Action)
-        """
-        
+    def _begin_step(self, current_state):
         current_state.chat_nums +=1
         state_begin = current_state.is_begin
         agent_begin = self.begins[current_state.name]["is_begin"]
         self.begins[current_state.name]["is_begin"] = False
         current_state.is_begin = False
-        environment = self.environment
         
         self.current_state = current_state
         # 先根据当前环境更新信息
         # First update the information according to the current environment
+        if not self.is_user and len(self.environment.shared_memory["long_term_memory"])>0:
+            current_history = self.observe()
+            self.long_term_memory.append(current_history)
+        return state_begin, agent_begin
+
+    def _get_action(self, current_state, response, res_dict, state_begin, agent_begin):
+        action_dict =  {
+            "response": response,
+            "res_dict": res_dict,
+            "role": self.state_roles[current_state.name],
+            "name": self.name,
+            "state_begin" : state_begin,
+            "agent_begin" : agent_begin,
+            "is_user" : self.is_user
+        }
+        return  Action(**action_dict)
+
+    def step(self, current_state,input=""):
+        """
+        return actions by current state and environment
+        Return: action(Action)
+        """
+        state_begin, agent_begin = self._begin_step(current_state)
         
         response = " "
         res_dict = {}
@@ -122,25 +140,32 @@ class Agent:
         if self.is_user:
             response = f"{self.name}:{input}"
         else:
-            if len(environment.shared_memory["long_term_memory"])>0:
-                current_history = self.observe()
-                self.long_term_memory.append(current_history)
             if agent_begin:
                 response = (char for char in self.begins[current_state.name]["begin_query"])
             else:
                 response,res_dict = self.act()
         
-        
-        action_dict =  {
-            "response": response,
-            "res_dict": res_dict,
-            "role": self.state_roles[current_state.name],
-            "name": self.name,
-            "state_begin" : state_begin,
-            "agent_begin" : agent_begin,
-            "is_user" : self.is_user
-        }
-        return  Action(**action_dict)
+        return self._get_action(current_state, response, res_dict, state_begin, agent_begin)
+
+    async def astep(self, current_state,input=""):
+        """
+        async version of step, the response of the action is an async generator when the agent acts
+        Return: action(Action)
+        """
+        state_begin, agent_begin = self._begin_step(current_state)
+
+        response = " "
+        res_dict = {}
+
+        if self.is_user:
+            response = f"{self.name}:{input}"
+        else:
+            if agent_begin:
+                response = (char for char in self.begins[current_state.name]["begin_query"])
+            else:
+                response,res_dict = await self.aact()
+
+        return self._get_action(current_state, response, res_dict, state_begin, agent_begin)
 
     def act(self):
         """
@@ -159,7 +184,27 @@ class Agent:
         )
         return response,res_dict 
 
-    def update_memory(self, memory):
+    async def aact(self):
+        """
+        async version of act
+        """
+        current_state = self.current_state
+        chat_history = self.long_term_memory
+        current_LLM = self.LLMs[current_state.name]
+
+        # 工具组件（检索、搜索等）是同步调用，放到线程中执行，不阻塞其他会话
+        # the tool components (retrieval, search...) are blocking, they run in a thread so that the other sessions go on
+        system_prompt, last_prompt, res_dict = await asyncio.to_thread(self.compile)
+
+        response = await current_LLM.aget_response(
+            chat_history, system_prompt, last_prompt, stream=True
+        )
+        return response,res_dict
+
+    def _get_summary_prompt(self, memory):
+        """
+        append the memory and return the prompt to summarize, return None if there is no need to summarize
+        """
         self.long_term_memory.append(
             {"role": "assistant", "content": memory.content}
         )
@@ -185,7 +230,22 @@ class Agent:
                 else f"""your name is {self.name},your role is{current_component_dict["style"].role},your task is {current_component_dict["task"].task}.\n"""
             )
             summary_prompt =eval(Agent_summary_system_prompt)
-            summary = self.LLMs[current_state.name].get_response(None, summary_prompt,stream = False)
+            return summary_prompt
+        return None
+
+    def update_memory(self, memory):
+        summary_prompt = self._get_summary_prompt(memory)
+        if summary_prompt:
+            summary = self.LLMs[self.current_state.name].get_response(None, summary_prompt,stream = False)
+            self.short_term_memory = summary
+
+    async def aupdate_memory(self, memory):
+        """
+        async version of update_memory
+        """
+        summary_prompt = self._get_summary_prompt(memory)
+        if summary_prompt:
+            summary = await self.LLMs[self.current_state.name].aget_response(None, summary_prompt,stream = False)
             self.short_term_memory = summary
             
         
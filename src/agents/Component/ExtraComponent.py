@@ -1,45 +1,28 @@
 from .ToolComponent import ToolComponent
 import json
-from utils import flatten_dict,get_embedding,matching_category,search_with_api,limit_keys,limit_values
+from utils import matching_category,search_with_api,limit_keys,limit_values
+from category_index import get_category_index
 import os
 
 
 class CategoryRequirementsComponent(ToolComponent):
     def __init__(self, information_path):
         super().__init__()
-        self.information_dataset = []
-        self.leaf_name = []
-        for toy_path in information_path:
-            with open(toy_path, encoding="utf-8") as json_file:
-                data = json.load(json_file)
-            for d in data:
-                if "/" in d["cat_leaf_name"]:
-                    leaf_names = d["cat_leaf_name"].split("/") + [d["cat_leaf_name"]]
-                else:
-                    leaf_names = [d["cat_leaf_name"]]
-                for name in leaf_names:
-                    self.leaf_name.append(name)
-                    new_d = d.copy()
-                    new_d["cat_leaf_name"] = name
-                    new_d["information"] = flatten_dict(new_d["information"])
-                    self.information_dataset.append(new_d)
+        # 类目索引在第一次启动时建立并保存，之后只需内存映射
+        # the category index is built on the first start and memory-mapped afterwards
+        self.category_index = get_category_index(information_path)
+        self.leaf_name = self.category_index.names
+        self.target_embbeding = self.category_index.embeddings
 
-        self.target_embbeding = get_embedding(
-            self.leaf_name
-        )
-
-    def search_information(self, category, information_dataset):
-        knowledge = {}
-        for d in information_dataset:
-            if category == d["cat_leaf_name"]:
-                knowledge = d["information"]
-                knowledge = {
-                    key: value
-                    for key, value in knowledge.items()
-                    if (value and key != "相关分类")
-                }
-                break
-        return knowledge
+    def search_information(self, category):
+        record = self.category_index.get(category)
+        if record is None:
+            return {}
+        return {
+            key: value
+            for key, value in record["information"].items()
+            if (value and key != "相关分类")
+        }
 
     def func(self, agent):
         prompt = ""
@@ -100,9 +83,7 @@ class CategoryRequirementsComponent(ToolComponent):
         if top1_score > MIN_CATEGORY_SIM:
             agent.environment.shared_memory["category"] = topk_result[0][0]
             category = topk_result[0][0]
-            information = self.search_information(
-                topk_result[0][0], self.information_dataset
-            )
+            information = self.search_information(topk_result[0][0])
             information = limit_keys(information, 3)
             information = limit_values(information, 2)
             prompt += f"""你需要知道的是：用户目前选择的商品是{category}，该商品信息为{information}。你需要根据这些商品信息来详细介绍商品，比如详细介绍商品有哪些品牌，有哪些分类等等，并且询问用户是否有更多的需求。"""
@@ -1,18 +1,19 @@
 from abc import abstractmethod
 import uuid
-from text2vec import semantic_search
 from utils import (
-    get_relevant_history,
-    load_knowledge_base_qa,
-    load_knowledge_base_UnstructuredFile,
     get_embedding,
     extract,
 )
 import json
+from bm25 import reciprocal_rank_fusion
+from vector_index import maximal_marginal_relevance
+from LLM.context import count_tokens
+import numpy as np
+from knowledge_base import get_knowledge_base_registry
 from typing import Dict, List
 import os
 from googleapiclient.discovery import build
-import requests
+from transport import get_session
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -44,25 +45,119 @@ class KnowledgeBaseComponent(ToolComponent):
     Inject knowledge base
     top_k : Top_k with the highest matching degree
     type : "QA" or others
-    knowledge_base(json_path) : knowledge_base_path
+    knowledge_base(json_path or binary directory) : knowledge_base_path
+    index(dict) : how the knowledge base is searched, see vector_index.get_index
+                  "bm25" : also search the keywords (default True), "rrf_k" : the constant of the reciprocal rank fusion (default 60),
+                  "min_score" : the embedding score of the relevant hits (default 0.5)
+    mmr_lambda(float) : the weight of the relevance against the diversity of the injected contents
+    token_budget(int) : the max tokens of the injected contents, unlimited if None
+    candidates(int) : the distinct hits the contents are selected from, 4 * top_k (at least 20) by default
+    answers(int) : the QA pairs injected instead of top_k, the single best answer by default
     """
-    def __init__(self, top_k, type, knowledge_base):
+    def __init__(self, top_k, type, knowledge_base, index=None, mmr_lambda=0.7, token_budget=None, candidates=None, answers=1):
         super().__init__()
         self.top_k = top_k
+        self.answers = answers
+        self.mmr_lambda = mmr_lambda
+        self.token_budget = token_budget
+        self.candidates = candidates if candidates else max(20, 4 * top_k)
         self.type = type
         self.knowledge_base = knowledge_base
 
+        # the binary knowledge bases are memory-mapped instead of being read into memory,
+        # and the components of all the states and roles share one copy of each knowledge base
+        shared = get_knowledge_base_registry().acquire(self.knowledge_base, index)
+        self.registry_key = shared["key"]
+        knowledge_base = shared["knowledge_base"]
+        self.kb_embeddings = knowledge_base["embeddings"]
+        self.kb_chunks = knowledge_base["fields"]["chunk"]
         if self.type == "QA":
-            (
-                self.kb_embeddings,
-                self.kb_questions,
-                self.kb_answers,
-                self.kb_chunks,
-            ) = load_knowledge_base_qa(self.knowledge_base)
-        else:
-            self.kb_embeddings, self.kb_chunks = load_knowledge_base_UnstructuredFile(
-                self.knowledge_base
-            )
+            self.kb_questions = knowledge_base["fields"]["q"]
+            self.kb_answers = knowledge_base["fields"]["a"]
+        self.deleted = knowledge_base["deleted"]
+        self.index = shared["index"]
+        self.bm25 = shared["bm25"]
+        index = index if index else {}
+        self.rrf_k = index["rrf_k"] if "rrf_k" in index else 60
+        self.min_score = index["min_score"] if "min_score" in index else 0.5
+
+    def search(self, agent, query):
+        """
+        Search the keywords and the embeddings, and fuse their ranks.
+        If the query has codes (such as SKUs or model numbers) and entries hold all of them, those entries are returned without embedding the query.
+        A hit is relevant if its embedding scores at least min_score, or it holds all the terms of the query.
+        Return :
+            hits(list) : [{"corpus_id": int, "score": float, "relevant": bool}]
+            matched(bool) : whether any hit is relevant
+        """
+        keyword_hits, keywords = self.bm25.search(query, top_k=max(50, self.candidates), deleted=self.deleted) if self.bm25 else ([], 0)
+        exact_hits = [hit for hit in keyword_hits if keywords and hit["keywords"] == keywords]
+        if exact_hits:
+            for hit in exact_hits:
+                hit["relevant"] = True
+            return exact_hits, True
+        turn_context = agent.environment.turn_context if agent.environment else None
+        query_embedding = turn_context.get_embedding(query) if turn_context else get_embedding(query)
+        hits = self.index.search(query_embedding, top_k=max(50, self.candidates))
+        relevant = {hit["corpus_id"] for hit in hits if hit["score"] >= self.min_score}
+        relevant |= {hit["corpus_id"] for hit in keyword_hits if hit["coverage"] == 1}
+        if keyword_hits:
+            hits = reciprocal_rank_fusion([hits, keyword_hits], self.rrf_k, max(50, self.candidates))
+        for hit in hits:
+            hit["relevant"] = hit["corpus_id"] in relevant
+        return hits, len(relevant) > 0
+
+    def _get_content(self, idx):
+        if self.type == "QA":
+            return f"question:{self.kb_questions[idx]},answer:{self.kb_answers[idx]}\n\n"
+        return f"{self.kb_chunks[idx]}\n\n"
+
+    def select(self, hits, model):
+        """
+        Select at most top_k (answers for QA) non-redundant relevant contents within the token budget with maximal marginal relevance
+        Return : the selected contents
+        """
+        # the entries of one QA pair, or the same chunk, give the same content
+        contents, ids, scores = [], [], []
+        for hit in hits:
+            # the irrelevant hits are not injected to fill up top_k
+            if "relevant" in hit and not hit["relevant"]:
+                continue
+            content = self._get_content(hit["corpus_id"])
+            if content not in contents:
+                contents.append(content)
+                ids.append(hit["corpus_id"])
+                scores.append(hit["score"])
+                if len(contents) == self.candidates:
+                    break
+        if not contents:
+            return []
+        # the scores of the searches have different scales, the relevance is relative to the best hit
+        scores = np.maximum(np.array(scores, dtype=np.float32), 0)
+        relevance = scores / scores[0] if scores[0] > 0 else np.ones(len(scores), dtype=np.float32)
+        selected = maximal_marginal_relevance(
+            np.asarray(self.kb_embeddings[ids]),
+            relevance,
+            self.answers if self.type == "QA" else self.top_k,
+            self.mmr_lambda,
+            [count_tokens(content, model) for content in contents] if self.token_budget else None,
+            self.token_budget,
+        )
+        return [contents[i] for i in selected]
+
+    def release(self):
+        """
+        release the shared knowledge base, it is unloaded once no component holds it
+        """
+        if self.registry_key:
+            get_knowledge_base_registry().release(self.registry_key)
+            self.registry_key = None
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
 
     def func(self, agent):
         query = (
@@ -70,48 +165,15 @@ class KnowledgeBaseComponent(ToolComponent):
             if len(agent.long_term_memory) > 0
             else ""
         )
-        knowledge = ""
         query = extract(query, "query")
-        query_embedding = get_embedding(query)
-        hits = semantic_search(query_embedding, self.kb_embeddings, top_k=50)
-        hits = hits[0]
-        temp = []
-        if self.type == "QA":
-            for hit in hits:
-                matching_idx = hit["corpus_id"]
-                if self.kb_chunks[matching_idx] in temp:
-                    pass
-                else:
-                    knowledge = (
-                        knowledge
-                        + f"question:{self.kb_questions[matching_idx]},answer:{self.kb_answers[matching_idx]}\n\n"
-                    )
-                    temp.append(self.kb_answers[matching_idx])
-                    if len(temp) == 1:
-                        break
-            print(hits[0]["score"])
-            score = hits[0]["score"]
-            if score < 0.5:
-                return {"prompt": "No matching knowledge base"}
-            else:
-                return {"prompt": "The relevant content is: " + knowledge + "\n"}
-        else:
-            for hit in hits:
-                matching_idx = hit["corpus_id"]
-                if self.kb_chunks[matching_idx] in temp:
-                    pass
-                else:
-                    knowledge = knowledge + f"{self.kb_answers[matching_idx]}\n\n"
-                    temp.append(self.kb_answers[matching_idx])
-                    if len(temp) == self.top_k:
-                        break
-            print(hits[0]["score"])
-            score = hits[0]["score"]
-            if score < 0.5:
-                return {"prompt": "No matching knowledge base"}
-            else:
-                print(knowledge)
-                return {"prompt": "The relevant content is: " + knowledge + "\n"}
+        hits, matched = self.search(agent, query)
+        if not matched:
+            return {"prompt": "No matching knowledge base"}
+        model = agent.LLM.model if hasattr(agent.LLM, "model") else "gpt-3.5-turbo"
+        knowledge = "".join(self.select(hits, model))
+        if self.type != "QA":
+            print(knowledge)
+        return {"prompt": "The relevant content is: " + knowledge + "\n"}
 
 
 class StaticComponent(ToolComponent):
@@ -201,7 +263,7 @@ class WebSearchComponent(ToolComponent):
             "count": 10,
         }
         """start searching"""
-        response = requests.get(search_url, headers=headers, params=params)
+        response = get_session().get(search_url, headers=headers, params=params)
         response.raise_for_status()
         results = response.json()["webPages"]["value"]
         """execute"""
@@ -566,7 +628,7 @@ class WeatherComponet(ToolComponent):
             url = f"https://api.weatherbit.io/v2.0/current?city={city_name}&country={country_code}&key={self.api_key}"
         else:
             url = f"https://api.weatherbit.io/v2.0/history/daily?&city={city_name}&country={country_code}&start_date={start_date}&end_date={end_date}&key={self.api_key}"
-        response = requests.get(url)
+        response = get_session().get(url)
         data = response.json()
         return self._parse(data)
 
@@ -767,7 +829,7 @@ class TranslateComponent(ToolComponent):
 
         body = [{"text": content}]
 
-        request = requests.post(
+        request = get_session().post(
             constructed_url, params=params, headers=headers, json=body
         )
         response = request.json()
@@ -819,12 +881,8 @@ class FunctionComponent(ToolComponent):
     def func(self, agent):
         messages = agent.long_term_memory
         outputdict = {}
-        query = agent.long_term_memory[-1].content if len(agent.long_term_memory) > 0 else " "
-        relevant_history = get_relevant_history(
-            query,
-            agent.long_term_memory[:-1],
-            agent.chat_embeddings[:-1],
-        )
+        turn_context = agent.environment.turn_context if agent.environment else None
+        relevant_history = turn_context.get_relevant_history() if turn_context else []
         response = agent.LLM.get_response(
             messages,
             None,
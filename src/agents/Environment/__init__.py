@@ -1 +1,2 @@
-from .base_environment import Environment
\ No newline at end of file
+from .base_environment import Environment
+from .turn_context import TurnContext
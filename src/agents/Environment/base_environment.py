@@ -1,15 +1,17 @@
-from utils import get_relevant_history, get_embedding
+from utils import get_embedding
 import torch
+import asyncio
 from LLM.base_LLM import *
-from Memory import Memory
+from Memory import Memory, EmbeddingBuffer
 from Prompt import * 
+from .turn_context import TurnContext
 import json
 class Environment:
     """
     The place where the agent activities, responsible for storing some shared memories
     """
     def __init__(self, config) -> None:
-        self.shared_memory = {"long_term_memory": [], "short_term_memory": None}
+        self.shared_memory = {"long_term_memory": [], "short_term_memory": None, "chat_embeddings": EmbeddingBuffer()}
         self.agents = None
 
         self.summary_system_prompt = {}
@@ -18,6 +20,9 @@ class Environment:
         self.environment_type = config["environment_type"] if "environment_type" in config else "cooperative"
         self.current_chat_history_idx = 0
         self.LLMs = {}
+        # 最新一条消息的上下文，每轮只计算一次
+        # The context of the latest message, computed once per turn
+        self.turn_context = None
         
         # 初始化每个state 的summary 方法
         # Initialize the summary method for each state
@@ -50,21 +55,14 @@ class Environment:
             config = json.load(f)
         return cls(config)
 
-    def summary(self, current_state):
+    def _get_summary_prompt(self, current_state):
         """
-        Summarize the situation in the current environment every once in a while
+        Splice the system prompt used to summarize the current environment
         """
         MAX_CHAT_HISTORY = eval(os.environ["MAX_CHAT_HISTORY"])
         current_state_name = current_state.name
 
-        query = self.shared_memory["long_term_memory"][-1].content
-        relevant_history = get_relevant_history(
-            query,
-            self.shared_memory["long_term_memory"][:-1],
-            self.shared_memory["chat_embeddings"][:-1],
-        )
-
-        relevant_history = Memory.get_chat_history(relevant_history)
+        relevant_history = Memory.get_chat_history(self.turn_context.get_relevant_history())
         chat_history = Memory.get_chat_history(
             self.shared_memory["long_term_memory"][-MAX_CHAT_HISTORY + 1 :]
         )
@@ -78,27 +76,57 @@ class Environment:
         summary_system_prompt = self.summary_system_prompt[current_state_name]
         
         environment_summary_system_prompt = eval(Environment_summary_system_prompt)
-        response = self.LLMs[current_state_name].get_response(None, environment_summary_system_prompt, stream=False)
+        return environment_summary_system_prompt
+
+    def summary(self, current_state):
+        """
+        Summarize the situation in the current environment every once in a while
+        """
+        environment_summary_system_prompt = self._get_summary_prompt(current_state)
+        response = self.LLMs[current_state.name].get_response(None, environment_summary_system_prompt, stream=False)
         return response
 
+    async def asummary(self, current_state):
+        """
+        async version of summary
+        """
+        environment_summary_system_prompt = self._get_summary_prompt(current_state)
+        response = await self.LLMs[current_state.name].aget_response(None, environment_summary_system_prompt, stream=False)
+        return response
+
+    def _append_memory(self, memory, current_embedding):
+        self.shared_memory["long_term_memory"].append(memory)
+        self.shared_memory["chat_embeddings"].append(current_embedding)
+        self.turn_context = TurnContext(
+            memory, current_embedding, len(self.shared_memory["long_term_memory"]) - 1, self.shared_memory
+        )
+
     def update_memory(self, memory, current_state):
         """
         update chat embbedings and long term memory,short term memory,agents long term memory
         """
         MAX_CHAT_HISTORY = eval(os.environ["MAX_CHAT_HISTORY"])
-        self.shared_memory["long_term_memory"].append(memory)
-        current_embedding = get_embedding(memory.content)
-        if "chat_embeddings" not in self.shared_memory:
-            self.shared_memory["chat_embeddings"] = current_embedding
-        else:
-            self.shared_memory["chat_embeddings"] = torch.cat(
-                [self.shared_memory["chat_embeddings"], current_embedding], dim=0
-            )
+        self._append_memory(memory, get_embedding(memory.content))
         if len(self.shared_memory["long_term_memory"]) % MAX_CHAT_HISTORY == 0:
             summary = self.summary(current_state)
             self.shared_memory["short_term_memory"] = summary
 
         self.agents[memory.send_name].update_memory(memory)
+
+    async def aupdate_memory(self, memory, current_state):
+        """
+        async version of update_memory
+        """
+        MAX_CHAT_HISTORY = eval(os.environ["MAX_CHAT_HISTORY"])
+        # 向量化可能是一次网络请求，放到线程中执行，不阻塞事件循环
+        # embedding may be a network call, it runs in a thread so that the event loop is not blocked
+        current_embedding = await asyncio.to_thread(get_embedding, memory.content)
+        self._append_memory(memory, current_embedding)
+        if len(self.shared_memory["long_term_memory"]) % MAX_CHAT_HISTORY == 0:
+            summary = await self.asummary(current_state)
+            self.shared_memory["short_term_memory"] = summary
+
+        await self.agents[memory.send_name].aupdate_memory(memory)
     
     
     def _get_agent_last_conversation_idx(self,agent,current_long_term_memory):
@@ -138,17 +166,10 @@ class Environment:
         # cooperative:Sharing information between different states ;  competive: No information is shared between different states
         current_chat_history_idx = self.current_chat_history_idx if self.environment_type == "competive" else 0
         current_long_term_memory = self.shared_memory["long_term_memory"][current_chat_history_idx:]
-        current_chat_embbedings = self.shared_memory["chat_embeddings"][current_chat_history_idx:]
             
         
         # relevant_memory
-        query = current_long_term_memory[-1].content
-
-        relevant_memory = get_relevant_history(
-            query,
-            current_long_term_memory[:-1],
-            current_chat_embbedings[:-1],
-        )
+        relevant_memory = self.turn_context.get_relevant_history(current_chat_history_idx)
         relevant_memory = Memory.get_chat_history(relevant_memory,agent.name)
         
         relevant_memory = eval(Agent_observe_relevant_memory)
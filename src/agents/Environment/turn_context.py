@@ -0,0 +1,40 @@
+from utils import get_relevant_history, get_embedding
+
+
+class TurnContext:
+    """
+    What the environment knows about its latest message, computed once per turn
+    and shared by the SOP, the environment summary, the agents' observation and the components.
+    memory(Memory) : the latest message
+    embedding(torch.Tensor) : [1, dim] embedding of the content of the message
+    index(int) : the position of the message in the long term memory
+    """
+    def __init__(self, memory, embedding, index, shared_memory):
+        self.memory = memory
+        self.embedding = embedding
+        self.index = index
+        self.shared_memory = shared_memory
+        # key:the start of the searched history  value:the top-k relevant memories
+        self.relevant_history = {}
+
+    def get_embedding(self, text):
+        """
+        the embedding of the message is reused when the text is the message itself
+        """
+        if text == self.memory.content:
+            return self.embedding
+        return get_embedding(text)
+
+    def get_relevant_history(self, start=0):
+        """
+        Return : the memories in long_term_memory[start:index] most relevant to the message
+        """
+        if start not in self.relevant_history:
+            history = self.shared_memory["long_term_memory"][start:self.index]
+            self.relevant_history[start] = get_relevant_history(
+                self.memory.content,
+                history,
+                self.shared_memory["chat_embeddings"][start:self.index],
+                query_embedding=self.embedding,
+            ) if history else []
+        return self.relevant_history[start]
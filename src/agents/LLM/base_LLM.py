@@ -2,65 +2,141 @@ from abc import abstractclassmethod
 import openai
 import os
 import time
+import asyncio
+import threading
+import hashlib
+import json
+import re
 from Memory import Memory
-from utils import save_logs
+from utils import save_logs, single_flight
+from cache import TieredCache, get_cache_key, get_cache_dir
+from LLM.context import pack_messages, count_message_tokens
+from LLM.scheduler import get_scheduler
+from LLM.hedge import get_hedger, PrefetchedStream, AsyncPrefetchedStream
+from transport import get_openai_kwargs, set_openai_async_session
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the process-wide cache of LLM responses, None if it is turned off by LLM_CACHE=0
+    LLM_CACHE_SIZE : the max number of responses kept in memory
+    LLM_CACHE_PATH : the sqlite file of the disk tier ({CACHE_DIR}/llm_cache.db by default), empty to keep only the memory tier
+    LLM_CACHE_TTL : seconds before a cached response expires
+    """
+    global _response_cache
+    if "LLM_CACHE" in os.environ and os.environ["LLM_CACHE"] == "0":
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = TieredCache(
+                max_size=eval(os.environ["LLM_CACHE_SIZE"]) if "LLM_CACHE_SIZE" in os.environ else 1024,
+                path=os.environ["LLM_CACHE_PATH"] if "LLM_CACHE_PATH" in os.environ else os.path.join(get_cache_dir(), "llm_cache.db"),
+                ttl=eval(os.environ["LLM_CACHE_TTL"]) if "LLM_CACHE_TTL" in os.environ else 7 * 24 * 3600,
+            )
+    return _response_cache
 
 class LLM:
     def __init__(self) -> None:
         pass
 
-    @abstractclassmethod 
+    @abstractclassmethod
     def get_response():
         pass
 
+    @abstractclassmethod
+    async def aget_response():
+        pass
+
 
 class OpenAILLM(LLM):
     def __init__(self,**kwargs) -> None:
         super().__init__()
-        self.MAX_CHAT_HISTORY = eval(
-            os.environ["MAX_CHAT_HISTORY"]) if "MAX_CHAT_HISTORY" in os.environ else 10
-        
+        # tokens reserved for the completion when the messages are packed into the context window
+        self.reserved_tokens = eval(
+            os.environ["RESERVED_TOKENS"]) if "RESERVED_TOKENS" in os.environ else 1024
+
         self.model = kwargs["model"] if "model" in kwargs else "gpt-3.5-turbo-16k-0613"
         self.temperature = kwargs["temperature"] if "temperature" in  kwargs else 0.3
         self.log_path = kwargs["log_path"].replace("/",os.sep) if "log_path" in kwargs else "logs"
-    
 
-    def get_stream(self,response, log_path, messages):
+
+    def get_stream(self,response, log_path, messages, cache_key=None, start_time=None):
+        """
+        yield the deltas of the response, the chunks are recorded with their time offsets
+        so that the whole completion can be replayed from the cache
+        """
         ans = ""
+        chunks = []
+        start_time = start_time if start_time else time.time()
         for res in response:
             if res:
                 r = (res.choices[0]["delta"].get("content")
                     if res.choices[0]["delta"].get("content") else "")
                 ans += r
+                chunks.append([time.time() - start_time, r])
                 yield r
-        
+
         save_logs(log_path, messages, ans)
-        
-        
-        
-    def get_response(self,
-                    chat_history,
-                    system_prompt,
-                    last_prompt=None,
-                    stream=False,
-                    functions=None,
-                    function_call="auto",
-                    WAIT_TIME=20,
-                    **kwargs):
+        if cache_key:
+            get_response_cache().set(cache_key, {"chunks": chunks})
+
+
+    async def aget_stream(self,response, log_path, messages, cache_key=None, start_time=None):
+        """
+        async version of get_stream, iterate it with `async for`
+        """
+        ans = ""
+        chunks = []
+        start_time = start_time if start_time else time.time()
+        async for res in response:
+            if res:
+                r = (res.choices[0]["delta"].get("content")
+                    if res.choices[0]["delta"].get("content") else "")
+                ans += r
+                chunks.append([time.time() - start_time, r])
+                yield r
+
+        save_logs(log_path, messages, ans)
+        if cache_key:
+            get_response_cache().set(cache_key, {"chunks": chunks})
+
+
+    def replay_stream(self, record):
+        """
+        replay a cached stream through the same generator interface as get_stream.
+        LLM_CACHE_REPLAY : "fast" yields all chunks at once, "timed" keeps the original timing
+        """
+        timed = "LLM_CACHE_REPLAY" in os.environ and os.environ["LLM_CACHE_REPLAY"] == "timed"
+        last_offset = 0
+        for offset, chunk in record["chunks"]:
+            if timed and offset > last_offset:
+                time.sleep(offset - last_offset)
+            last_offset = offset
+            yield chunk
+
+
+    async def areplay_stream(self, record):
         """
-        return LLM's response 
+        async version of replay_stream
+        """
+        timed = "LLM_CACHE_REPLAY" in os.environ and os.environ["LLM_CACHE_REPLAY"] == "timed"
+        last_offset = 0
+        for offset, chunk in record["chunks"]:
+            if timed and offset > last_offset:
+                await asyncio.sleep(offset - last_offset)
+            last_offset = offset
+            yield chunk
+
+
+    def _get_messages(self, chat_history, system_prompt, last_prompt=None):
+        """
+        splice system prompt, chat history and last prompt into the messages of openai
         """
-        openai.api_key = os.environ["API_KEY"]
-        if "PROXY" in os.environ:
-            assert "http:" in os.environ["PROXY"] or "socks" in os.environ["PROXY"],"PROXY error,PROXY must be http or socks"
-            openai.proxy = os.environ["PROXY"]
-        if "API_BASE" in os.environ:
-            openai.api_base = os.environ["API_BASE"]
         active_mode = True if ("ACTIVE_MODE" in os.environ and os.environ["ACTIVE_MODE"] == "0") else False
-        model = self.model
-        temperature = self.temperature
-        
-        
+
         if active_mode:
             system_prompt = system_prompt + "Please keep your reply as concise as possible,Within three sentences, the total word count should not exceed 30"
 
@@ -68,10 +144,8 @@ class OpenAILLM(LLM):
             "role": "system",
             "content": system_prompt
         }] if system_prompt else []
-        
+
         if chat_history:
-            if len(chat_history) >  self.MAX_CHAT_HISTORY:
-                chat_history = chat_history[- self.MAX_CHAT_HISTORY:]
             if isinstance(chat_history[0],dict):
                 messages += chat_history
             elif isinstance(chat_history[0],Memory):
@@ -82,42 +156,341 @@ class OpenAILLM(LLM):
                 last_prompt = last_prompt + "Please keep your reply as concise as possible,Within three sentences, the total word count should not exceed 30"
             # messages += [{"role": "system", "content": f"{last_prompt}"}]
             messages[-1]["content"] += last_prompt
-        
 
+        # the oldest history is dropped first so that the messages fit in the context window
+        return pack_messages(messages, self.model, self.reserved_tokens)
+
+
+    def _get_request_kwargs(self, messages, stream, functions, function_call):
+        if functions:
+            return {
+                "model": self.model,
+                "messages": messages,
+                "functions": functions,
+                "function_call": function_call,
+                "temperature": self.temperature,
+            }
+        return {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "stream": stream,
+        }
+
+
+    def _get_cache_key(self, messages, functions, function_call, stream=False):
+        """
+        Return the key of the response cache, None if the request should not be cached.
+        Only the deterministic requests are cached, sampled temperatures above LLM_CACHE_MAX_TEMPERATURE are not.
+        Streamed completions are cached apart from the non-stream ones since they are stored as timed chunks.
+        """
+        max_temperature = eval(os.environ["LLM_CACHE_MAX_TEMPERATURE"]) if "LLM_CACHE_MAX_TEMPERATURE" in os.environ else 0
+        if self.temperature > max_temperature or get_response_cache() is None:
+            return None
+        messages = [
+            {
+                "role": message["role"],
+                "content": message["content"].strip() if message["content"] else message["content"],
+            }
+            for message in messages
+        ]
+        return get_cache_key(self.model, self.temperature, functions, function_call if functions else None, messages, stream)
+
+
+    def _get_result(self, response, messages, functions, cache_key):
+        """
+        log the non-stream response and store it in the cache
+        Return : the message of function call or the content of the response
+        """
+        save_logs(self.log_path, messages, response)
+        if functions:
+            result = response.choices[0].message
+        else:
+            result = response.choices[0].message["content"]
+        if cache_key:
+            get_response_cache().set(cache_key, result)
+        return result
+
+
+    def _shrink_budget(self, request_kwargs, budget_ratio):
+        budget_ratio *= 0.8
+        assert budget_ratio > 0.3, "exceed max length"
+        request_kwargs["messages"] = pack_messages(
+            request_kwargs["messages"], self.model, self.reserved_tokens, budget_ratio
+        )
+        return budget_ratio
+
+
+    def _count_tokens(self, request_kwargs):
+        return sum(count_message_tokens(message, self.model) for message in request_kwargs["messages"])
+
+
+    def _send(self, request_kwargs, endpoint_kwargs):
+        """
+        the upstream call, endpoint_kwargs are the per-request arguments of openai such as api_key and api_base
+        """
+        return openai.ChatCompletion.create(**request_kwargs, **endpoint_kwargs)
+
+
+    async def _asend(self, request_kwargs, endpoint_kwargs):
+        return await openai.ChatCompletion.acreate(**request_kwargs, **endpoint_kwargs)
+
+
+    def _create(self, request_kwargs):
+        """
+        call openai, the streams are hedged across the endpoints in HEDGE_ENDPOINTS if they are configured.
+        The hedged request takes its own share of the rate limits and is not sent if they are used up.
+        The complete responses are not hedged, their latency depends on their length rather than on the endpoint.
+        """
+        hedger = get_hedger()
+        stream = "stream" in request_kwargs and request_kwargs["stream"]
+        if hedger is None or not stream:
+            return self._send(request_kwargs, get_openai_kwargs())
+
+        def create(endpoint_kwargs):
+            response = self._send(request_kwargs, endpoint_kwargs)
+            # a stream is returned once its first chunk arrives
+            return PrefetchedStream(next(iter(response)), response)
+
+        tokens = self._count_tokens(request_kwargs)
+        return hedger.call(
+            self.model, create, get_openai_kwargs(), lambda: get_scheduler().try_acquire(self.model, tokens)
+        )
+
+
+    async def _acreate(self, request_kwargs):
+        hedger = get_hedger()
+        stream = "stream" in request_kwargs and request_kwargs["stream"]
+        if hedger is None or not stream:
+            return await self._asend(request_kwargs, get_openai_kwargs())
+
+        async def acreate(endpoint_kwargs):
+            response = await self._asend(request_kwargs, endpoint_kwargs)
+            return AsyncPrefetchedStream(await response.__anext__(), response)
+
+        tokens = self._count_tokens(request_kwargs)
+        return await hedger.acall(
+            self.model, acreate, get_openai_kwargs(), lambda: get_scheduler().try_acquire(self.model, tokens)
+        )
+
+
+    def _request(self, request_kwargs, WAIT_TIME):
+        """
+        send the request through the shared scheduler, WAIT_TIME is the max seconds of backoff
+        """
+        scheduler = get_scheduler()
+        budget_ratio = 1.0
+        attempt = 0
         while True:
+            scheduler.acquire(self.model, self._count_tokens(request_kwargs))
             try:
-                if functions:
-                    response = openai.ChatCompletion.create(
-                        model=model,
-                        messages=messages,
-                        functions=functions,
-                        function_call=function_call,
-                        temperature=temperature,
-                    )
+                response = self._create(request_kwargs)
+                break
+            except Exception as e:
+                print(e)
+                if "maximum context length is" in str(e):
+                    # the token count is an estimate, pack the messages into a smaller budget and resend
+                    budget_ratio = self._shrink_budget(request_kwargs, budget_ratio)
                 else:
-                    response = openai.ChatCompletion.create(
-                        model=model,
-                        messages=messages,
-                        temperature=temperature,
-                        stream=stream)
+                    delay = scheduler.backoff(self.model, attempt, e, WAIT_TIME)
+                    attempt += 1
+                    print(f"Please wait {delay:.1f} seconds and resend later ...")
+                    time.sleep(delay)
+        return response
+
+
+    async def _arequest(self, request_kwargs, WAIT_TIME):
+        scheduler = get_scheduler()
+        budget_ratio = 1.0
+        attempt = 0
+        while True:
+            await scheduler.aacquire(self.model, self._count_tokens(request_kwargs))
+            set_openai_async_session()
+            try:
+                response = await self._acreate(request_kwargs)
                 break
             except Exception as e:
                 print(e)
                 if "maximum context length is" in str(e):
-                    assert False, "exceed max length"
-                    break
+                    budget_ratio = self._shrink_budget(request_kwargs, budget_ratio)
                 else:
-                    print(f"Please wait {WAIT_TIME} seconds and resend later ...")
-                    time.sleep(WAIT_TIME)
+                    delay = scheduler.backoff(self.model, attempt, e, WAIT_TIME)
+                    attempt += 1
+                    print(f"Please wait {delay:.1f} seconds and resend later ...")
+                    await asyncio.sleep(delay)
+        return response
 
-        if functions:
-            save_logs(self.log_path, messages, response)
-            return response.choices[0].message
-        elif stream:
-            return self.get_stream(response, self.log_path, messages)
-        else:
-            save_logs(self.log_path, messages, response)
-            return response.choices[0].message["content"]
+
+    def _get_completion(self, request_kwargs, messages, functions, cache_key, WAIT_TIME):
+        response = self._request(request_kwargs, WAIT_TIME)
+        return self._get_result(response, messages, functions, cache_key)
+
+
+    async def _aget_completion(self, request_kwargs, messages, functions, cache_key, WAIT_TIME):
+        response = await self._arequest(request_kwargs, WAIT_TIME)
+        return self._get_result(response, messages, functions, cache_key)
+
+
+    def get_response(self,
+                    chat_history,
+                    system_prompt,
+                    last_prompt=None,
+                    stream=False,
+                    functions=None,
+                    function_call="auto",
+                    WAIT_TIME=20,
+                    **kwargs):
+        """
+        return LLM's response
+        """
+        messages = self._get_messages(chat_history, system_prompt, last_prompt)
+        request_kwargs = self._get_request_kwargs(messages, stream, functions, function_call)
+
+        cache_key = self._get_cache_key(messages, functions, function_call, stream and not functions)
+        if cache_key:
+            cached_response = get_response_cache().get(cache_key)
+            if cached_response is not None:
+                return self.replay_stream(cached_response) if stream and not functions else cached_response
+
+        if stream and not functions:
+            start_time = time.time()
+            response = self._request(request_kwargs, WAIT_TIME)
+            return self.get_stream(response, self.log_path, messages, cache_key, start_time)
+
+        # concurrent identical requests share one upstream call
+        return single_flight.do(
+            get_cache_key("chat", request_kwargs),
+            self._get_completion, request_kwargs, messages, functions, cache_key, WAIT_TIME
+        )
+
+
+    async def aget_response(self,
+                    chat_history,
+                    system_prompt,
+                    last_prompt=None,
+                    stream=False,
+                    functions=None,
+                    function_call="auto",
+                    WAIT_TIME=20,
+                    **kwargs):
+        """
+        async version of get_response, the event loop is not blocked while waiting for the LLM.
+        if stream is True, return an async generator which should be iterated with `async for`
+        """
+        messages = self._get_messages(chat_history, system_prompt, last_prompt)
+        request_kwargs = self._get_request_kwargs(messages, stream, functions, function_call)
+
+        cache_key = self._get_cache_key(messages, functions, function_call, stream and not functions)
+        if cache_key:
+            cached_response = get_response_cache().get(cache_key)
+            if cached_response is not None:
+                return self.areplay_stream(cached_response) if stream and not functions else cached_response
+
+        if stream and not functions:
+            start_time = time.time()
+            response = await self._arequest(request_kwargs, WAIT_TIME)
+            return self.aget_stream(response, self.log_path, messages, cache_key, start_time)
+
+        return await single_flight.ado(
+            get_cache_key("chat", request_kwargs),
+            self._aget_completion, request_kwargs, messages, functions, cache_key, WAIT_TIME
+        )
+
+
+class MockObject(dict):
+    """
+    dict which can also be read by attributes, like the responses of openai
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class MockLLM(OpenAILLM):
+    """
+    Deterministic offline LLM for load testing, no request leaves the process.
+    It shares the message packing, caching, scheduling and hedging of OpenAILLM, only the upstream call (_send) is simulated.
+    responses(list or dict) : scripted responses, a list is replied in turn,
+        a dict replies the value of the first key found in the last message.
+        Without a script the response is derived from the hash of the messages.
+    latency(float) : seconds before the request is answered, besides ttft
+    ttft(float) : seconds to the first token
+    token_rate(float) : tokens generated per second, 0 means no generation time
+    """
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.responses = kwargs["responses"] if "responses" in kwargs else None
+        self.latency = kwargs["latency"] if "latency" in kwargs else 0
+        self.ttft = kwargs["ttft"] if "ttft" in kwargs else 0
+        self.token_rate = kwargs["token_rate"] if "token_rate" in kwargs else 0
+        self.response_index = 0
+        self.lock = threading.Lock()
+
+    def _get_content(self, messages):
+        if isinstance(self.responses, list) and self.responses:
+            with self.lock:
+                content = self.responses[self.response_index % len(self.responses)]
+                self.response_index += 1
+            return content
+        last_message = messages[-1]["content"] if messages else ""
+        if isinstance(self.responses, dict):
+            for key, value in self.responses.items():
+                if key in last_message:
+                    return value
+        digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return " ".join(digest[i:i + 8] for i in range(0, len(digest), 8))
+
+    def _get_function_call(self, request_kwargs):
+        functions = request_kwargs["functions"]
+        function_call = request_kwargs["function_call"]
+        name = function_call["name"] if isinstance(function_call, dict) else functions[0]["name"]
+        function = [function for function in functions if function["name"] == name][0]
+        digest = hashlib.sha256(json.dumps(request_kwargs["messages"], ensure_ascii=False).encode("utf-8")).hexdigest()
+        arguments = {key: digest[:8] for key in function["parameters"]["properties"]}
+        return {"name": name, "arguments": json.dumps(arguments)}
+
+    def _get_tokens(self, content):
+        return re.findall(r"[\u4e00-\u9fff]|\S+\s*|\s+", content)
+
+    def _get_message(self, request_kwargs):
+        if "functions" in request_kwargs:
+            return MockObject(role="assistant", content=None, function_call=self._get_function_call(request_kwargs))
+        return MockObject(role="assistant", content=self._get_content(request_kwargs["messages"]))
+
+    def _get_delay(self, tokens):
+        return self.latency + self.ttft + (len(tokens) / self.token_rate if self.token_rate else 0)
+
+    def _stream(self, tokens):
+        time.sleep(self.latency + self.ttft)
+        for i, token in enumerate(tokens):
+            if i and self.token_rate:
+                time.sleep(1 / self.token_rate)
+            yield MockObject(choices=[MockObject(delta={"content": token})])
+
+    async def _astream(self, tokens):
+        await asyncio.sleep(self.latency + self.ttft)
+        for i, token in enumerate(tokens):
+            if i and self.token_rate:
+                await asyncio.sleep(1 / self.token_rate)
+            yield MockObject(choices=[MockObject(delta={"content": token})])
+
+    def _send(self, request_kwargs, endpoint_kwargs):
+        message = self._get_message(request_kwargs)
+        tokens = self._get_tokens(message["content"] or "")
+        if "stream" in request_kwargs and request_kwargs["stream"]:
+            return self._stream(tokens)
+        time.sleep(self._get_delay(tokens))
+        return MockObject(choices=[MockObject(message=message)])
+
+    async def _asend(self, request_kwargs, endpoint_kwargs):
+        message = self._get_message(request_kwargs)
+        tokens = self._get_tokens(message["content"] or "")
+        if "stream" in request_kwargs and request_kwargs["stream"]:
+            return self._astream(tokens)
+        await asyncio.sleep(self._get_delay(tokens))
+        return MockObject(choices=[MockObject(message=message)])
 
 
 def init_LLM(default_log_path,**kwargs):
@@ -130,4 +503,10 @@ def init_LLM(default_log_path,**kwargs):
             else OpenAILLM(model = "gpt-3.5-turbo-16k-0613",temperature=0.3,log_path=log_path)
         )
         return LLM
-    
\ No newline at end of file
+    elif LLM_type == "Mock":
+        LLM = (
+            MockLLM(**kwargs["LLM"])
+            if "LLM" in kwargs
+            else MockLLM(model = "gpt-3.5-turbo-16k-0613",temperature=0.3,log_path=log_path)
+        )
+        return LLM
@@ -0,0 +1,131 @@
+"""token-aware packing of the messages sent to the LLM"""
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# context window of each model, the longest matching prefix is used for the model versions not listed
+MODEL_CONTEXT_WINDOW = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0613": 32768,
+}
+
+# tokens used by the role and separators of each message and by the priming of the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_encodings = {}
+
+
+def get_context_window(model):
+    """
+    Return the context window of the model, CONTEXT_WINDOW in os.environ overrides it
+    """
+    if "CONTEXT_WINDOW" in os.environ:
+        return eval(os.environ["CONTEXT_WINDOW"])
+    if model in MODEL_CONTEXT_WINDOW:
+        return MODEL_CONTEXT_WINDOW[model]
+    prefixes = [name for name in MODEL_CONTEXT_WINDOW if model.startswith(name)]
+    if prefixes:
+        return MODEL_CONTEXT_WINDOW[max(prefixes, key=len)]
+    return 4096
+
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text, model):
+    """
+    Count the tokens of the text with tiktoken, estimate them if tiktoken is not installed:
+    one token per CJK character and one token per four other characters
+    """
+    if not text:
+        return 0
+    if tiktoken:
+        return len(_get_encoding(model).encode(text))
+    cjk = len(re.findall(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(message, model):
+    return TOKENS_PER_MESSAGE + count_tokens(message["content"], model)
+
+
+def truncate_text(text, max_tokens, model):
+    """
+    Cut the middle of the text so that it fits in max_tokens, the beginning and the end are kept
+    """
+    tokens = count_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if tiktoken:
+        encoding = _get_encoding(model)
+        ids = encoding.encode(text)
+        half = max_tokens // 2
+        return encoding.decode(ids[:half]) + "\n...\n" + encoding.decode(ids[len(ids) - (max_tokens - half):])
+    keep = int(len(text) * max_tokens / tokens)
+    half = keep // 2
+    return text[:half] + "\n...\n" + text[len(text) - (keep - half):]
+
+
+def pack_messages(messages, model, reserved_tokens=1024, budget_ratio=1.0):
+    """
+    Pack the messages into the context window of the model.
+    The system prompt and the last message are kept intact, the history in the middle is filled
+    from the newest to the oldest until the budget is used up, so the oldest messages are dropped first.
+    Only if the system prompt and the last message alone exceed the budget, their middles are cut.
+    Args:
+        messages(list) : messages of openai
+        reserved_tokens(int) : room left for the completion
+        budget_ratio(float) : the ratio of the window that can be used, lowered when the estimate is too optimistic
+    Return :
+        messages(list) : the packed messages
+    """
+    budget = int(get_context_window(model) * budget_ratio) - reserved_tokens - TOKENS_PER_REPLY
+    if not messages:
+        return messages
+
+    head = [messages[0]] if messages[0]["role"] == "system" and len(messages) > 1 else []
+    tail = [messages[-1]]
+    middle = messages[len(head):-1]
+
+    fixed_tokens = sum(count_message_tokens(message, model) for message in head + tail)
+    if fixed_tokens > budget:
+        # cut the longer one of the system prompt and the last message first
+        fixed = head + tail
+        for i in sorted(range(len(fixed)), key=lambda i: -count_message_tokens(fixed[i], model)):
+            overflow = fixed_tokens - budget
+            if overflow <= 0:
+                break
+            tokens = count_message_tokens(fixed[i], model)
+            fixed[i] = dict(fixed[i], content=truncate_text(fixed[i]["content"], tokens - TOKENS_PER_MESSAGE - overflow, model))
+            fixed_tokens += count_message_tokens(fixed[i], model) - tokens
+        return fixed
+
+    remaining = budget - fixed_tokens
+    kept = []
+    for message in reversed(middle):
+        tokens = count_message_tokens(message, model)
+        if tokens > remaining:
+            break
+        kept.append(message)
+        remaining -= tokens
+    kept.reverse()
+    return head + kept + tail
@@ -0,0 +1,187 @@
+"""hedged requests across multiple LLM endpoints"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class PrefetchedStream:
+    """
+    A stream whose first chunk has already arrived, iterated like the original stream
+    """
+    def __init__(self, first, response):
+        self.first = first
+        self.response = response
+
+    def __iter__(self):
+        yield self.first
+        yield from self.response
+
+    def close(self):
+        if hasattr(self.response, "close"):
+            self.response.close()
+
+
+class AsyncPrefetchedStream:
+    """
+    async version of PrefetchedStream
+    """
+    def __init__(self, first, response):
+        self.first = first
+        self.response = response
+
+    async def __aiter__(self):
+        yield self.first
+        async for res in self.response:
+            yield res
+
+    async def aclose(self):
+        if hasattr(self.response, "aclose"):
+            await self.response.aclose()
+
+
+def _close(result):
+    if hasattr(result, "close"):
+        result.close()
+
+
+async def _aclose(result):
+    if hasattr(result, "aclose"):
+        await result.aclose()
+
+
+class Hedger:
+    """
+    Send the streamed request to the primary endpoint, and if its first token has not arrived
+    within the given percentile of the recent latencies, send the same request to a hedge endpoint.
+    The first response to arrive is used and the other one is cancelled.
+    endpoints(list) : the hedge endpoints, each is the per-request arguments of openai such as {"api_key":..., "api_base":...}
+    percentile(float) : the percentile of recent first-token latencies after which the request is hedged
+    min_samples(int) : before this many latencies are recorded, the request is hedged after default_delay
+    """
+    def __init__(self, endpoints, percentile=95, min_samples=20, default_delay=5, window=200, max_workers=32):
+        self.endpoints = endpoints
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.latencies = {}
+        self.window = window
+        self.lock = threading.Lock()
+        self.next_endpoint = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_delay(self, key):
+        with self.lock:
+            latencies = sorted(self.latencies[key]) if key in self.latencies else []
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[index]
+
+    def record(self, key, latency):
+        with self.lock:
+            if key not in self.latencies:
+                self.latencies[key] = deque(maxlen=self.window)
+            self.latencies[key].append(latency)
+
+    def _get_hedge_endpoint(self, primary):
+        with self.lock:
+            endpoint = self.endpoints[self.next_endpoint % len(self.endpoints)]
+            self.next_endpoint += 1
+        return dict(primary, **endpoint)
+
+    def call(self, key, func, primary, admit=None):
+        """
+        func(endpoint) sends the request to the endpoint and returns once the first token arrives
+        admit() returns whether the rate limits leave room for the hedged request, it is not sent otherwise
+        Return : the result of the faster endpoint
+        """
+        start_time = time.time()
+        futures = [self.executor.submit(func, primary)]
+        done, _ = wait(futures, timeout=self.get_delay(key))
+        if not done and (admit is None or admit()):
+            futures.append(self.executor.submit(func, self._get_hedge_endpoint(primary)))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.record(key, time.time() - start_time)
+                    # cancel the losers, if one is already running its response is closed once it arrives
+                    for loser in futures:
+                        if loser is not future:
+                            loser.cancel()
+                            loser.add_done_callback(
+                                lambda loser: loser.cancelled() or loser.exception() or _close(loser.result())
+                            )
+                    return future.result()
+                error = error if error else future.exception()
+        raise error
+
+    async def acall(self, key, func, primary, admit=None):
+        """
+        async version of call, func is a coroutine function
+        """
+        start_time = time.time()
+        tasks = [asyncio.ensure_future(func(primary))]
+        done, _ = await asyncio.wait(tasks, timeout=self.get_delay(key))
+        if not done and (admit is None or admit()):
+            tasks.append(asyncio.ensure_future(func(self._get_hedge_endpoint(primary))))
+
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.record(key, time.time() - start_time)
+                        for loser in tasks:
+                            if loser is not task and loser.done() and loser.exception() is None:
+                                await _aclose(loser.result())
+                        return task.result()
+                    error = error if error else task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+_hedger = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger():
+    """
+    Return the process-wide hedger, None if no hedge endpoint is configured.
+    HEDGE_ENDPOINTS : json list, such as [{"API_KEY": "key2", "API_BASE": "https://second.endpoint/v1"}]
+    HEDGE_PERCENTILE : hedge once the first token is later than this percentile of recent latencies
+    HEDGE_MIN_SAMPLES & HEDGE_DEFAULT_DELAY : the delay used before enough latencies are recorded
+    """
+    global _hedger
+    if "HEDGE_ENDPOINTS" not in os.environ:
+        return None
+    with _hedger_lock:
+        if _hedger is None:
+            endpoints = []
+            for endpoint in json.loads(os.environ["HEDGE_ENDPOINTS"]):
+                kwargs = {}
+                if "API_KEY" in endpoint:
+                    kwargs["api_key"] = endpoint["API_KEY"]
+                if "API_BASE" in endpoint:
+                    kwargs["api_base"] = endpoint["API_BASE"]
+                endpoints.append(kwargs)
+            if not endpoints:
+                return None
+            _hedger = Hedger(
+                endpoints,
+                percentile=eval(os.environ["HEDGE_PERCENTILE"]) if "HEDGE_PERCENTILE" in os.environ else 95,
+                min_samples=eval(os.environ["HEDGE_MIN_SAMPLES"]) if "HEDGE_MIN_SAMPLES" in os.environ else 20,
+                default_delay=eval(os.environ["HEDGE_DEFAULT_DELAY"]) if "HEDGE_DEFAULT_DELAY" in os.environ else 5,
+            )
+    return _hedger
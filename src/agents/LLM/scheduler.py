@@ -0,0 +1,177 @@
+"""rate-limit-aware scheduling of the requests sent to the LLM"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+
+class RateLimitScheduler:
+    """
+    Shared by all OpenAILLM instances of the process.
+    Every model has a budget of requests per minute (rpm) and tokens per minute (tpm),
+    the waiting requests are admitted in FIFO order, and failed requests are retried
+    with jittered exponential backoff which honors the Retry-After header.
+    limits(dict) : key:model  value:{"rpm":int, "tpm":int}, the "default" key is used for the other models
+    """
+    def __init__(self, limits=None, base_delay=1, window=60):
+        self.limits = limits if limits else {}
+        self.base_delay = base_delay
+        self.window = window
+        self.condition = threading.Condition()
+        self.models = {}
+
+    def _get_model(self, model):
+        if model not in self.models:
+            limit = self.limits[model] if model in self.limits else (
+                self.limits["default"] if "default" in self.limits else {}
+            )
+            self.models[model] = {
+                "rpm": limit["rpm"] if "rpm" in limit else None,
+                "tpm": limit["tpm"] if "tpm" in limit else None,
+                # (timestamp, tokens) of the requests admitted in the last window
+                "history": deque(),
+                "tokens": 0,
+                "next_ticket": 0,
+                "serving": 0,
+                "abandoned": set(),
+                "paused_until": 0,
+            }
+        return self.models[model]
+
+    def _take_ticket(self, model):
+        with self.condition:
+            state = self._get_model(model)
+            ticket = state["next_ticket"]
+            state["next_ticket"] += 1
+            return ticket
+
+    def _try_acquire(self, model, tokens, ticket):
+        """
+        Return 0 if the request is admitted, otherwise the seconds to wait before trying again
+        """
+        with self.condition:
+            state = self._get_model(model)
+            while state["serving"] in state["abandoned"]:
+                state["abandoned"].remove(state["serving"])
+                state["serving"] += 1
+            if state["serving"] != ticket:
+                return 0.05
+
+            now = time.time()
+            if state["paused_until"] > now:
+                return state["paused_until"] - now
+
+            history = state["history"]
+            while history and now - history[0][0] >= self.window:
+                state["tokens"] -= history.popleft()[1]
+
+            wait = 0
+            if state["rpm"] and len(history) >= state["rpm"]:
+                wait = history[0][0] + self.window - now
+            # a request larger than the whole tpm budget is admitted once the window is empty
+            if state["tpm"] and history and state["tokens"] + tokens > state["tpm"]:
+                tokens_to_free = state["tokens"] + tokens - state["tpm"]
+                for timestamp, history_tokens in history:
+                    tokens_to_free -= history_tokens
+                    if tokens_to_free <= 0:
+                        wait = max(wait, timestamp + self.window - now)
+                        break
+            if wait > 0:
+                return wait
+
+            history.append((now, tokens))
+            state["tokens"] += tokens
+            state["serving"] += 1
+            self.condition.notify_all()
+            return 0
+
+    def _abandon(self, model, ticket):
+        with self.condition:
+            state = self._get_model(model)
+            if ticket >= state["serving"]:
+                state["abandoned"].add(ticket)
+            self.condition.notify_all()
+
+    def acquire(self, model, tokens=0):
+        """
+        Block until the request fits in the budget of the model and all earlier requests are admitted
+        """
+        ticket = self._take_ticket(model)
+        try:
+            while True:
+                wait = self._try_acquire(model, tokens, ticket)
+                if wait == 0:
+                    return
+                with self.condition:
+                    self.condition.wait(timeout=wait)
+        except BaseException:
+            self._abandon(model, ticket)
+            raise
+
+    async def aacquire(self, model, tokens=0):
+        """
+        async version of acquire
+        """
+        ticket = self._take_ticket(model)
+        try:
+            while True:
+                wait = self._try_acquire(model, tokens, ticket)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait, 0.05))
+        except BaseException:
+            self._abandon(model, ticket)
+            raise
+
+    def try_acquire(self, model, tokens=0):
+        """
+        Admit the request only if it fits in the budget of the model now and no request is waiting before it
+        Return : whether the request is admitted
+        """
+        ticket = self._take_ticket(model)
+        if self._try_acquire(model, tokens, ticket) == 0:
+            return True
+        self._abandon(model, ticket)
+        return False
+
+    def backoff(self, model, attempt, error, max_delay=20):
+        """
+        Return the seconds to wait before retrying a failed request.
+        If the server sent Retry-After, all the requests of the model are paused for that long.
+        """
+        retry_after = None
+        headers = getattr(error, "headers", None)
+        if headers:
+            try:
+                retry_after = float(headers.get("Retry-After") or headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+
+        if retry_after is not None:
+            with self.condition:
+                state = self._get_model(model)
+                state["paused_until"] = max(state["paused_until"], time.time() + retry_after)
+            return retry_after
+
+        delay = min(max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the process-wide scheduler.
+    RATE_LIMITS : json, such as {"default": {"rpm": 3500, "tpm": 90000}, "gpt-4": {"rpm": 200, "tpm": 10000}}
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            limits = json.loads(os.environ["RATE_LIMITS"]) if "RATE_LIMITS" in os.environ else {}
+            _scheduler = RateLimitScheduler(limits)
+    return _scheduler
@@ -1 +1,2 @@
-from .base_Memory import Memory
\ No newline at end of file
+from .base_Memory import Memory
+from .embedding_buffer import EmbeddingBuffer
@@ -0,0 +1,68 @@
+import torch
+
+
+class EmbeddingBuffer:
+    """
+    Growable embedding matrix, the capacity doubles when it is full so appending is amortized O(1).
+    Slicing returns views of the filled rows without copying, e.g. buffer[idx:-1].
+    The rows are kept in float32: the chat history is small, and the relevance search scans it directly.
+    capacity(int) : the rows allocated at first
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+
+    def append(self, embedding):
+        """
+        embedding(torch.Tensor) : [dim] or [n, dim]
+        """
+        if len(embedding.shape) == 1:
+            embedding = embedding.unsqueeze(0)
+        n = embedding.shape[0]
+        embedding = embedding.float()
+        if self.data is None:
+            self.capacity = max(self.capacity, n)
+            self.data = torch.empty(
+                (self.capacity, embedding.shape[1]), dtype=embedding.dtype, device=embedding.device
+            )
+        elif self.size + n > self.capacity:
+            while self.size + n > self.capacity:
+                self.capacity *= 2
+            data = torch.empty(
+                (self.capacity, self.data.shape[1]), dtype=self.data.dtype, device=self.data.device
+            )
+            data[: self.size] = self.data[: self.size]
+            # the views handed out before still point to the old matrix, which is freed once they are gone
+            self.data = data
+        self.data[self.size : self.size + n] = embedding
+        self.size += n
+
+    def as_tensor(self):
+        """
+        Return : [size, dim] view of the filled rows
+        """
+        if self.data is None:
+            return torch.empty((0, 0))
+        return self.data[: self.size]
+
+    def __getitem__(self, idx):
+        return self.as_tensor()[idx]
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def shape(self):
+        if self.data is None:
+            return torch.Size((0, 0))
+        return torch.Size((self.size, self.data.shape[1]))
+
+    def memory_usage(self):
+        """
+        Return : {"used": bytes of the filled rows, "allocated": bytes of the whole matrix}
+        """
+        if self.data is None:
+            return {"used": 0, "allocated": 0}
+        row_bytes = self.data.shape[1] * self.data.element_size()
+        return {"used": self.size * row_bytes, "allocated": self.capacity * row_bytes}
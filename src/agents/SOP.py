@@ -17,11 +17,13 @@
 import random
 from LLM.base_LLM import *
 from State import State
-from utils import extract, get_relevant_history
+from utils import extract, get_relevant_history, get_embedding
 from Memory import Memory
 from Prompt import *
 import json
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 class SOP:
     """
@@ -53,6 +55,12 @@ class SOP:
         self.names_to_roles = None
         self.finished = False
 
+        # speculative mode: predict the next state and role as soon as the current agent's response has streamed,
+        # the prediction is used only if the memory the controller reads next holds exactly the predicted response
+        self.speculative = kwargs["speculative"] if "speculative" in kwargs else False
+        self.speculation = None
+        self.speculation_executor = ThreadPoolExecutor(max_workers=2) if self.speculative else None
+
     @classmethod
     def from_config(cls, config_path):
         with open(config_path) as f:
@@ -79,6 +87,58 @@ class SOP:
             for idx, next_state_name in state_relation.items():
                 self.states[state_name].next_states[idx] = self.states[next_state_name]
 
+    def _get_transit_prompt(self, chat_history, **kwargs):
+        """
+        Splice the prompts that the controller uses to judge the next state
+        Return :
+        chat_messages(list), transit_system_prompt(str), transit_last_prompt(str), extract_words(str)
+        """
+        current_state = self.current_state
+        controller_dict = self.controller_dict[current_state.name]
+        relevant_history = kwargs["relevant_history"]
+
+        # 否则则让controller判断是否结束
+        # Otherwise, let the controller judge whether to end
+        judge_system_prompt = controller_dict["judge_system_prompt"] if "judge_system_prompt" in controller_dict else ""
+        environment_prompt = eval(Get_environment_prompt) if current_state.environment_prompt else ""
+        transit_system_prompt = eval(Transit_system_prompt)
+
+        judge_last_prompt = controller_dict["judge_last_prompt"] if "judge_last_prompt" in controller_dict else ""
+        transit_last_prompt = eval(Transit_last_prompt)
+
+
+
+        environment = kwargs["environment"]
+        environment_summary = environment.shared_memory["short_term_memory"]
+        chat_history_message = Memory.get_chat_history(chat_history)
+        query = chat_history[-1].get_query()
+
+        chat_messages = [
+            {
+                "role": "user",
+                "content": eval(Transit_message)
+            }
+        ]
+
+        extract_words = controller_dict["judge_extract_words"] if "judge_extract_words" in controller_dict else "end"
+        return chat_messages, transit_system_prompt, transit_last_prompt, extract_words
+
+    def _parse_transit_response(self, response, extract_words):
+        next_state = (
+            response if response.isdigit() else extract(response, extract_words)
+        )
+
+        # 如果没有parse出来则继续循环
+        # If no parse comes out, continue looping
+        if not next_state.isdigit():
+            next_state = "0"
+        return next_state
+
+    def _reach_max_chat_nums(self):
+        controller_dict = self.controller_dict[self.current_state.name]
+        max_chat_nums = controller_dict["max_chat_nums"] if "max_chat_nums" in controller_dict else 1000
+        return self.current_state.chat_nums >= max_chat_nums
+
     def transit(self, chat_history, **kwargs):
         """
         Determine the next state based on the current situation
@@ -93,56 +153,119 @@ class SOP:
         # 否则则需要controller去判断进入哪一节点
         # Otherwise, the controller needs to determine which node to enter.   
         else:
-            current_state = self.current_state
-            controller_dict = self.controller_dict[current_state.name]
-            relevant_history = kwargs["relevant_history"]
-            
-            max_chat_nums = controller_dict["max_chat_nums"] if "max_chat_nums" in controller_dict else 1000
-            if current_state.chat_nums>=max_chat_nums:
+            if self._reach_max_chat_nums():
                 return self.current_state.next_states["1"]
-            
 
-            # 否则则让controller判断是否结束
-            # Otherwise, let the controller judge whether to end
-            judge_system_prompt = controller_dict["judge_system_prompt"] if "judge_system_prompt" in controller_dict else ""
-            environment_prompt = eval(Get_environment_prompt) if current_state.environment_prompt else ""
-            transit_system_prompt = eval(Transit_system_prompt)
-            
-            judge_last_prompt = controller_dict["judge_last_prompt"] if "judge_last_prompt" in controller_dict else ""
-            transit_last_prompt = eval(Transit_last_prompt)
-            
+            chat_messages, transit_system_prompt, transit_last_prompt, extract_words = self._get_transit_prompt(
+                chat_history, **kwargs
+            )
+            response = self.LLM.get_response(
+                chat_messages, transit_system_prompt, transit_last_prompt, stream=False, **kwargs
+            )
+            next_state = self._parse_transit_response(response, extract_words)
 
-            
-            environment = kwargs["environment"]
-            environment_summary = environment.shared_memory["short_term_memory"]
-            chat_history_message = Memory.get_chat_history(chat_history)
-            query = chat_history[-1].get_query()
-            
-            chat_messages = [
-                {
-                    "role": "user",
-                    "content": eval(Transit_message)
-                }
-            ]
-            
-            extract_words = controller_dict["judge_extract_words"] if "judge_extract_words" in controller_dict else "end"
+        next_state = self.current_state.next_states[next_state]
+        return next_state
 
+    async def atransit(self, chat_history, **kwargs):
+        """
+        async version of transit
+        Return : 
+        next_state(State) : the next state
+        """
+        if len(self.current_state.next_states) == 1:
+            next_state = "0"
+        else:
+            if self._reach_max_chat_nums():
+                return self.current_state.next_states["1"]
 
-            response = self.LLM.get_response(
-                chat_messages, transit_system_prompt, transit_last_prompt, stream=False, **kwargs
+            chat_messages, transit_system_prompt, transit_last_prompt, extract_words = self._get_transit_prompt(
+                chat_history, **kwargs
             )
-            next_state = (
-                response if response.isdigit() else extract(response, extract_words)
+            response = await self.LLM.aget_response(
+                chat_messages, transit_system_prompt, transit_last_prompt, stream=False, **kwargs
             )
-            
-            # 如果没有parse出来则继续循环
-            # If no parse comes out, continue looping
-            if not next_state.isdigit():
-                next_state = "0"
-            
+            next_state = self._parse_transit_response(response, extract_words)
+
         next_state = self.current_state.next_states[next_state]
         return next_state
 
+    def _get_controller_type(self):
+        return (
+            self.controller_dict[self.current_state.name]["controller_type"]
+            if "controller_type" in self.controller_dict[self.current_state.name]
+            else "order"
+        )
+
+    def _get_route_prompt(self, chat_history, **kwargs):
+        """
+        Splice the prompts that the rule controller uses to assign the next role
+        Return :
+        chat_messages(list), call_system_prompt(str), call_last_prompt(str), extract_words(str)
+        """
+        relevant_history = kwargs["relevant_history"]
+        controller_dict = self.controller_dict[self.current_state.name]
+        
+        call_last_prompt = controller_dict["call_last_prompt"] if "call_last_prompt" in controller_dict else ""
+        
+        allocate_prompt = ""
+        roles = list(set(self.current_state.roles))
+        for role in roles:
+            allocate_prompt += eval(Allocate_component)
+            
+        call_system_prompt = controller_dict["call_system_prompt"]  if "call_system_prompt" in controller_dict else ""
+        environment_prompt = eval(Get_environment_prompt) if self.current_state.environment_prompt else ""    
+        # call_system_prompt + environment + allocate_prompt 
+        call_system_prompt = eval(Call_system_prompt)
+        
+        query = chat_history[-1].get_query()
+        last_name = chat_history[-1].send_name
+        # last_prompt: note + last_prompt + query
+        call_last_prompt =eval(Call_last_prompt)
+        
+        
+        chat_history_message = Memory.get_chat_history(chat_history)
+        # Intermediate historical conversation records
+        chat_messages = [
+            {
+                "role": "user",
+                "content": eval(Call_message),
+            }
+        ]
+
+        extract_words = controller_dict["call_extract_words"] if "call_extract_words" in controller_dict else "end"
+        return chat_messages, call_system_prompt, call_last_prompt, extract_words
+
+    def _get_next_role(self, controller_type):
+        """
+        Assign the next role for the controllers which do not need LLM
+        """
+        # Speak in order
+        if controller_type == "order":
+            # If there is no begin role, it will be given directly to the first person.
+            if not self.current_state.current_role:
+                next_role = self.current_state.roles[0]
+            # otherwise first
+            else:
+                self.current_state.index += 1
+                self.current_state.index =  (self.current_state.index) % len(self.current_state.roles)
+                next_role = self.current_state.roles[self.current_state.index]
+        # random speak
+        elif controller_type == "random":
+            next_role = random.choice(self.current_state.roles)
+        return next_role
+
+    def _get_next_agent(self, next_role, agents):
+        # 如果下一角色不在，则随机挑选一个
+        # If the next character is not available, pick one at random    
+        if next_role not in self.current_state.roles:
+            next_role = random.choice(self.current_state.roles)
+            
+        self.current_state.current_role = next_role 
+        
+        next_agent = agents[self.roles_to_names[self.current_state.name][next_role]]
+        
+        return next_agent
 
     def route(self, chat_history, **kwargs):
         """
@@ -158,84 +281,63 @@ class SOP:
         if len(self.current_state.roles) == 1:
             next_role = self.current_state.roles[0]
         
-        
-        
         # 否则controller进行分配
         # Otherwise the controller determines
         else:
-            relevant_history = kwargs["relevant_history"]
-            controller_type = (
-                self.controller_dict[self.current_state.name]["controller_type"]
-                if "controller_type" in self.controller_dict[self.current_state.name]
-                else "order"
-            )
-
+            controller_type = self._get_controller_type()
 
             # 如果是rule 控制器，则交由LLM进行分配角色
             # If  controller type is rule, it is left to LLM to assign roles.
-            if controller_type == "rule":
-                controller_dict = self.controller_dict[self.current_state.name]
-                
-                call_last_prompt = controller_dict["call_last_prompt"] if "call_last_prompt" in controller_dict else ""
-                
-                allocate_prompt = ""
-                roles = list(set(self.current_state.roles))
-                for role in roles:
-                    allocate_prompt += eval(Allocate_component)
-                    
-                call_system_prompt = controller_dict["call_system_prompt"]  if "call_system_prompt" in controller_dict else ""
-                environment_prompt = eval(Get_environment_prompt) if self.current_state.environment_prompt else ""    
-                # call_system_prompt + environment + allocate_prompt 
-                call_system_prompt = eval(Call_system_prompt)
-                
-                query = chat_history[-1].get_query()
-                last_name = chat_history[-1].send_name
-                # last_prompt: note + last_prompt + query
-                call_last_prompt =eval(Call_last_prompt)
-                
-                
-                chat_history_message = Memory.get_chat_history(chat_history)
-                # Intermediate historical conversation records
-                chat_messages = [
-                    {
-                        "role": "user",
-                        "content": eval(Call_message),
-                    }
-                ]
-
-                extract_words = controller_dict["call_extract_words"] if "call_extract_words" in controller_dict else "end"
-
+            if controller_type == "rule" and "next_role" in kwargs and kwargs["next_role"]:
+                # the role predicted by the confirmed speculation
+                next_role = kwargs["next_role"]
+            elif controller_type == "rule":
+                chat_messages, call_system_prompt, call_last_prompt, extract_words = self._get_route_prompt(
+                    chat_history, **kwargs
+                )
                 response = self.LLM.get_response(
                     chat_messages, call_system_prompt, call_last_prompt, stream=False, **kwargs
                 )
 
                 # get next role
                 next_role = extract(response, extract_words)
+            else:
+                next_role = self._get_next_role(controller_type)
 
-            # Speak in order
-            elif controller_type == "order":
-                # If there is no begin role, it will be given directly to the first person.
-                if not self.current_state.current_role:
-                    next_role = self.current_state.roles[0]
-                # otherwise first
-                else:
-                    self.current_state.index += 1
-                    self.current_state.index =  (self.current_state.index) % len(self.current_state.roles)
-                    next_role = self.current_state.roles[self.current_state.index]
-            # random speak
-            elif controller_type == "random":
-                next_role = random.choice(self.current_state.roles)
-            
-        # 如果下一角色不在，则随机挑选一个
-        # If the next character is not available, pick one at random    
-        if next_role not in self.current_state.roles:
-            next_role = random.choice(self.current_state.roles)
-            
-        self.current_state.current_role = next_role 
-        
-        next_agent = agents[self.roles_to_names[self.current_state.name][next_role]]
-        
-        return next_agent
+        return self._get_next_agent(next_role, agents)
+
+    async def aroute(self, chat_history, **kwargs):
+        """
+        async version of route
+        Return : 
+        current_agent(Agent) : the next act agent
+        """
+        agents = kwargs["agents"]
+        if len(self.current_state.roles) == 1:
+            next_role = self.current_state.roles[0]
+        else:
+            controller_type = self._get_controller_type()
+            if controller_type == "rule" and "next_role" in kwargs and kwargs["next_role"]:
+                next_role = kwargs["next_role"]
+            elif controller_type == "rule":
+                chat_messages, call_system_prompt, call_last_prompt, extract_words = self._get_route_prompt(
+                    chat_history, **kwargs
+                )
+                response = await self.LLM.aget_response(
+                    chat_messages, call_system_prompt, call_last_prompt, stream=False, **kwargs
+                )
+                next_role = extract(response, extract_words)
+            else:
+                next_role = self._get_next_role(controller_type)
+
+        return self._get_next_agent(next_role, agents)
+
+    def _get_begin_agent(self, agents):
+        agent_name = self.roles_to_names[self.current_state.name][self.current_state.begin_role]
+        return agents[agent_name]
+
+    def _get_relevant_history(self, environment):
+        return Memory.get_chat_history(environment.turn_context.get_relevant_history())
     
     def next(self, environment, agents):
         """
@@ -246,23 +348,23 @@ class SOP:
         # If it is the first time to enter this state
         
         if self.current_state.is_begin:
-            agent_name = self.roles_to_names[self.current_state.name][self.current_state.begin_role]
-            agent = agents[agent_name]
-            return self.current_state,agent
+            return self.current_state,self._get_begin_agent(agents)
     
     
         # get relevant history
-        query = environment.shared_memory["long_term_memory"][-1].content
-        relevant_history = get_relevant_history(
-            query,
-            environment.shared_memory["long_term_memory"][:-1],
-            environment.shared_memory["chat_embeddings"][:-1],
-        )
-        relevant_history = Memory.get_chat_history(relevant_history)
-        
+        relevant_history = self._get_relevant_history(environment)
         
+        # 如果推测的结果被最终回复确认，则直接使用
+        # If the speculation is confirmed by the final response, use its prediction
+        future = self._take_speculation(environment)
+        prediction = None
+        if future:
+            try:
+                prediction = future.result()
+            except Exception as e:
+                print(e)
         
-        next_state = self.transit(
+        next_state = prediction["next_state"] if prediction else self.transit(
             chat_history=environment.shared_memory["long_term_memory"][
                 environment.current_chat_history_idx :
             ],
@@ -280,9 +382,7 @@ class SOP:
         # 如果是首次进入该节点且有开场白，则直接分配给开场角色
         # If it is the first time to enter the state and there is a begin query, it will be directly assigned to the begin role.
         if self.current_state.is_begin and self.current_state.begin_role:
-            agent_name = self.roles_to_names[self.current_state.name][self.current_state.begin_role]
-            agent = agents[agent_name]
-            return self.current_state,agent
+            return self.current_state,self._get_begin_agent(agents)
            
 
         next_agent = self.route(
@@ -291,6 +391,213 @@ class SOP:
             ],
             agents = agents,
             relevant_history=relevant_history,
+            next_role=prediction["next_role"] if prediction else None,
         )
 
         return self.current_state, next_agent
+
+    async def anext(self, environment, agents):
+        """
+        async version of next, the controller's LLM calls do not block the event loop
+        """
+        if self.current_state.is_begin:
+            return self.current_state,self._get_begin_agent(agents)
+
+        relevant_history = self._get_relevant_history(environment)
+
+        future = self._take_speculation(environment)
+        prediction = None
+        if future:
+            try:
+                # the speculations of aspeculate are tasks of the event loop, the ones of speculate run in threads
+                prediction = await (future if isinstance(future, asyncio.Future) else asyncio.wrap_future(future))
+            except Exception as e:
+                print(e)
+
+        next_state = prediction["next_state"] if prediction else await self.atransit(
+            chat_history=environment.shared_memory["long_term_memory"][
+                environment.current_chat_history_idx :
+            ],
+            relevant_history=relevant_history,
+            environment=environment,
+        )
+        if next_state.name == self.finish_state_name:
+            self.finished = True
+            return None, None
+
+        self.current_state = next_state
+
+        if self.current_state.is_begin and self.current_state.begin_role:
+            return self.current_state,self._get_begin_agent(agents)
+
+        next_agent = await self.aroute(
+            chat_history=environment.shared_memory["long_term_memory"][
+                environment.current_chat_history_idx :
+            ],
+            agents = agents,
+            relevant_history=relevant_history,
+            next_role=prediction["next_role"] if prediction else None,
+        )
+
+        return self.current_state, next_agent
+
+    def _need_controller_LLM(self):
+        if len(self.current_state.next_states) > 1:
+            return True
+        return len(self.current_state.roles) > 1 and self._get_controller_type() == "rule"
+
+    def speculate(self, action, environment):
+        """
+        Wrap the streaming response of the action in speculative mode.
+        Once it has streamed, the next state and role are predicted from it in the background,
+        so the controller's LLM calls overlap with the memory update and the output of the response.
+        Return : the response to be processed in place of action.response
+        """
+        if (
+            not self.speculative
+            or action.is_user
+            or hasattr(action.response, "__aiter__")
+            or not self._need_controller_LLM()
+        ):
+            return action.response
+        action.response = self._speculative_stream(action, environment, action.response)
+        return action.response
+
+    def aspeculate(self, action, environment):
+        """
+        async version of speculate for the async responses of astep, the prediction runs as a task of the event loop
+        Return : the response to be processed in place of action.response
+        """
+        if (
+            not self.speculative
+            or action.is_user
+            or not hasattr(action.response, "__aiter__")
+            or not self._need_controller_LLM()
+        ):
+            return action.response
+        action.response = self._aspeculative_stream(action, environment, action.response)
+        return action.response
+
+    def _speculative_stream(self, action, environment, response):
+        all = ""
+        for res in response:
+            all += res
+            yield res
+        self._launch_speculation(action, environment, all)
+
+    async def _aspeculative_stream(self, action, environment, response):
+        all = ""
+        async for res in response:
+            all += res
+            yield res
+        self._launch_speculation(action, environment, all, True)
+
+    def _launch_speculation(self, action, environment, all, is_async=False):
+        content = action.strip_name(all)
+        if not content:
+            return
+        if self.speculation:
+            self.speculation["future"].cancel()
+        memory = Memory(action.role, action.name, content)
+        chat_history = environment.shared_memory["long_term_memory"][
+            environment.current_chat_history_idx :
+        ] + [memory]
+        # 只在此处保存历史的快照，检索在后台进行，不阻塞流式输出
+        # only the history is snapshotted here, the retrieval runs in the background without blocking the stream
+        history = list(environment.shared_memory["long_term_memory"])
+        embeddings = environment.shared_memory["chat_embeddings"].as_tensor()
+        args = (chat_history, content, history, embeddings, environment)
+        self.speculation = {
+            "content": content,
+            "send_name": action.name,
+            "state": self.current_state,
+            "summary": environment.shared_memory["short_term_memory"],
+            "future": asyncio.ensure_future(self._apredict(*args)) if is_async else self.speculation_executor.submit(
+                self._predict, *args
+            ),
+        }
+
+    def _get_predicted_history(self, content, history, embeddings):
+        return Memory.get_chat_history(
+            get_relevant_history(content, history, embeddings, get_embedding(content))
+            if history
+            else []
+        )
+
+    def _need_predicted_role(self, current_state, next_state):
+        return (
+            next_state is current_state
+            and len(current_state.roles) > 1
+            and self._get_controller_type() == "rule"
+        )
+
+    def _predict(self, chat_history, content, history, embeddings, environment):
+        """
+        Predict the next state and, if the state stays, the role assigned by the rule controller.
+        Nothing of the SOP is modified here.
+        """
+        relevant_history = self._get_predicted_history(content, history, embeddings)
+        current_state = self.current_state
+        next_state = self.transit(
+            chat_history=chat_history,
+            relevant_history=relevant_history,
+            environment=environment,
+        )
+        next_role = None
+        if self._need_predicted_role(current_state, next_state):
+            chat_messages, call_system_prompt, call_last_prompt, extract_words = self._get_route_prompt(
+                chat_history, relevant_history=relevant_history
+            )
+            response = self.LLM.get_response(
+                chat_messages, call_system_prompt, call_last_prompt, stream=False
+            )
+            next_role = extract(response, extract_words)
+        return {"next_state": next_state, "next_role": next_role}
+
+    async def _apredict(self, chat_history, content, history, embeddings, environment):
+        """
+        async version of _predict
+        """
+        relevant_history = await asyncio.to_thread(self._get_predicted_history, content, history, embeddings)
+        current_state = self.current_state
+        next_state = await self.atransit(
+            chat_history=chat_history,
+            relevant_history=relevant_history,
+            environment=environment,
+        )
+        next_role = None
+        if self._need_predicted_role(current_state, next_state):
+            chat_messages, call_system_prompt, call_last_prompt, extract_words = self._get_route_prompt(
+                chat_history, relevant_history=relevant_history
+            )
+            response = await self.LLM.aget_response(
+                chat_messages, call_system_prompt, call_last_prompt, stream=False
+            )
+            next_role = extract(response, extract_words)
+        return {"next_state": next_state, "next_role": next_role}
+
+    def _is_confirmed(self, speculation, content):
+        # the controller reads the final response, a prediction from any other text may route differently
+        return (
+            speculation is not None
+            and not speculation["future"].cancelled()
+            and content == speculation["content"]
+        )
+
+    def _take_speculation(self, environment):
+        """
+        Return the future of the speculation if the final response confirms it, otherwise None
+        """
+        speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+        last_memory = environment.shared_memory["long_term_memory"][-1]
+        if (
+            speculation["state"] is not self.current_state
+            or speculation["send_name"] != last_memory.send_name
+            or speculation["summary"] != environment.shared_memory["short_term_memory"]
+            or not self._is_confirmed(speculation, last_memory.content)
+        ):
+            speculation["future"].cancel()
+            return None
+        return speculation["future"]
@@ -96,11 +96,19 @@ class State:
                         )
 
                     # "top_k"  "type" "knowledge_base" "system_prompt" "last_prompt"
+                    # "index" (optional) : {"type": "auto"/"exact"/"ivf", "min_size", "nlist", "nprobe", "quantization", "rescore", "bm25", "rrf_k", "min_score"}
+                    # "mmr_lambda" & "token_budget" & "candidates" (optional) : how the injected contents are diversified and limited
+                    # "answers" (optional) : the QA pairs injected, 1 by default
                     elif component == "KnowledgeBaseComponent":
                         component_dict["tool"] = KnowledgeBaseComponent(
                             component_args["top_k"],
                             component_args["type"],
                             component_args["knowledge_path"],
+                            component_args["index"] if "index" in component_args else None,
+                            component_args["mmr_lambda"] if "mmr_lambda" in component_args else 0.7,
+                            component_args["token_budget"] if "token_budget" in component_args else None,
+                            component_args["candidates"] if "candidates" in component_args else None,
+                            component_args["answers"] if "answers" in component_args else 1,
                         )
 
                     elif component == "CategoryRequirementsComponent":
@@ -0,0 +1,230 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""keyword search of the knowledge bases with BM25, fused with the embedding search"""
+import math
+import os
+import re
+import numpy as np
+from vector_index import _get_mtime, save_npz
+
+# the words, numbers and codes such as "ab-123" or "v2.1", and the runs of chinese characters
+_WORD_PATTERN = re.compile(r"[一-鿿]+|[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_CJK_PATTERN = re.compile(r"[一-鿿]")
+_SEPARATOR_PATTERN = re.compile(r"[-_./]")
+
+
+def tokenize(text):
+    """
+    the chinese characters are indexed as unigrams and bigrams, the codes also as their parts,
+    so that "AB-123" is matched by "ab-123" as well as by "ab 123"
+    """
+    tokens = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        if _CJK_PATTERN.match(word):
+            tokens += list(word) + [word[i:i + 2] for i in range(len(word) - 1)]
+        else:
+            tokens.append(word)
+            parts = _SEPARATOR_PATTERN.split(word)
+            if len(parts) > 1:
+                tokens += parts
+    return tokens
+
+
+def is_keyword(token):
+    """
+    the tokens that look like SKU codes or model numbers, which the embeddings hardly tell apart
+    """
+    return any(c.isdigit() for c in token) or _SEPARATOR_PATTERN.search(token) is not None
+
+
+def get_texts(fields):
+    """
+    Return : the text indexed for each entry, the question and the chunk for QA
+    """
+    if "q" in fields:
+        return [q + " " + chunk for q, chunk in zip(fields["q"], fields["chunk"])]
+    return list(fields["chunk"])
+
+
+class BM25Index:
+    """
+    inverted index in CSR format: the postings of the term t are doc_ids[offsets[t]:offsets[t + 1]], sorted by doc id
+    """
+    def __init__(self, vocab, offsets, doc_ids, tfs, doc_lens, k1=1.5, b=0.75):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.k1 = k1
+        self.b = b
+        self.avg_len = float(doc_lens.mean()) if len(doc_lens) else 0.0
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    @classmethod
+    def _from_postings(cls, vocab, term_ids, doc_ids, tfs, doc_lens):
+        order = np.lexsort((doc_ids, term_ids))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=offsets[1:])
+        return cls(vocab, offsets, doc_ids[order].astype(np.int32), tfs[order].astype(np.float32), doc_lens)
+
+    @staticmethod
+    def _count(texts, vocab, start=0):
+        term_ids, doc_ids, tfs, doc_lens = [], [], [], []
+        for doc_id, text in enumerate(texts, start):
+            tokens = tokenize(text)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts[token] + 1 if token in counts else 1
+            for token, count in counts.items():
+                if token not in vocab:
+                    vocab[token] = len(vocab)
+                term_ids.append(vocab[token])
+                doc_ids.append(doc_id)
+                tfs.append(count)
+            doc_lens.append(len(tokens))
+        return (
+            np.array(term_ids, dtype=np.int64),
+            np.array(doc_ids, dtype=np.int64),
+            np.array(tfs, dtype=np.float32),
+            np.array(doc_lens, dtype=np.float32),
+        )
+
+    @classmethod
+    def build(cls, texts):
+        vocab = {}
+        term_ids, doc_ids, tfs, doc_lens = cls._count(texts, vocab)
+        return cls._from_postings(vocab, term_ids, doc_ids, tfs, doc_lens)
+
+    def add(self, texts):
+        """
+        index the texts as the entries following the indexed ones
+        """
+        old_term_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        term_ids, doc_ids, tfs, doc_lens = self._count(texts, self.vocab, len(self.doc_lens))
+        index = self._from_postings(
+            self.vocab,
+            np.concatenate([old_term_ids, term_ids]),
+            np.concatenate([self.doc_ids, doc_ids]),
+            np.concatenate([self.tfs, tfs]),
+            np.concatenate([self.doc_lens, doc_lens]),
+        )
+        self.offsets, self.doc_ids, self.tfs = index.offsets, index.doc_ids, index.tfs
+        self.doc_lens, self.avg_len = index.doc_lens, index.avg_len
+        return self
+
+    def search(self, query, top_k=50, deleted=None):
+        """
+        Return :
+            hits(list) : [{"corpus_id": int, "score": float, "keywords": the keywords of the query in the entry,
+                           "coverage": the share of the query terms in the entry}]
+            keywords(int) : the number of keywords in the query, see is_keyword
+        """
+        terms = set(tokenize(query))
+        keywords = len([term for term in terms if is_keyword(term)])
+        total = len(terms)
+        terms = [term for term in terms if term in self.vocab]
+        if not terms or not len(self.doc_lens):
+            return [], keywords
+        docs, scores, matched, covered = [], [], [], []
+        for term in terms:
+            term_id = self.vocab[term]
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            term_docs, tfs = self.doc_ids[start:end], self.tfs[start:end]
+            idf = math.log(1 + (len(self.doc_lens) - (end - start) + 0.5) / (end - start + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[term_docs] / max(self.avg_len, 1e-6))
+            docs.append(term_docs)
+            scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+            matched.append(np.full(len(term_docs), is_keyword(term), dtype=np.int32))
+            covered.append(np.ones(len(term_docs), dtype=np.int32))
+        # only the entries holding a query term are scored
+        docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        matched = np.bincount(inverse, weights=np.concatenate(matched))
+        covered = np.bincount(inverse, weights=np.concatenate(covered))
+        if deleted is not None:
+            scores[np.asarray(deleted)[docs] != 0] = -np.inf
+        top = np.argsort(-scores)[:top_k]
+        return [
+            {
+                "corpus_id": int(docs[idx]),
+                "score": float(scores[idx]),
+                "keywords": int(matched[idx]),
+                "coverage": float(covered[idx]) / total,
+            }
+            for idx in top if scores[idx] != -np.inf
+        ], keywords
+
+    def save(self, path):
+        terms = sorted(self.vocab, key=self.vocab.get)
+        # the tokens never contain a new line
+        save_npz(
+            path,
+            terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+            offsets=self.offsets, doc_ids=self.doc_ids, tfs=self.tfs, doc_lens=self.doc_lens,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        terms = data["terms"].tobytes().decode("utf-8")
+        vocab = {term: idx for idx, term in enumerate(terms.split("\n"))} if terms else {}
+        return cls(vocab, data["offsets"], data["doc_ids"], data["tfs"], data["doc_lens"])
+
+
+def get_bm25_path(knowledge_base):
+    if os.path.isdir(knowledge_base):
+        return os.path.join(knowledge_base, "bm25.npz")
+    return knowledge_base + ".bm25.npz"
+
+
+def get_bm25(knowledge_base, fields):
+    """
+    Return the BM25 index of the knowledge base, loaded from next to it if it is up to date
+    fields(dict) : the fields of the knowledge base, see knowledge_base.load_knowledge_base
+    """
+    path = get_bm25_path(knowledge_base)
+    count = len(fields["chunk"])
+    saved = None
+    if os.path.exists(path) and os.path.getmtime(path) >= _get_mtime(knowledge_base):
+        saved = BM25Index.load(path)
+        if len(saved) == count:
+            return saved
+    index = BM25Index.build(get_texts(fields))
+    if saved is not None and len(saved) > count:
+        # saved by an append in progress, which is not counted by meta.json yet
+        return index
+    try:
+        index.save(path)
+    except OSError as e:
+        print(f"failed to save the BM25 index of {knowledge_base}: {e}")
+    return index
+
+
+def reciprocal_rank_fusion(rankings, k=60, top_k=50):
+    """
+    fuse the hits of several searches by their ranks, the scores of the searches are not comparable
+    Return : [{"corpus_id": int, "score": the fused score}]
+    """
+    scores = {}
+    for hits in rankings:
+        for rank, hit in enumerate(hits):
+            corpus_id = hit["corpus_id"]
+            scores[corpus_id] = (scores[corpus_id] if corpus_id in scores else 0) + 1 / (k + rank + 1)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [{"corpus_id": corpus_id, "score": score} for corpus_id, score in fused]
@@ -0,0 +1,208 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""content-addressed caches with an in-memory LRU tier and an on-disk SQLite tier"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def get_cache_dir():
+    """
+    Return the directory of the on-disk caches, independent of the working directory.
+    CACHE_DIR : the directory, ~/.cache/agents by default
+    """
+    if "CACHE_DIR" in os.environ and os.environ["CACHE_DIR"]:
+        return os.environ["CACHE_DIR"]
+    return os.path.join(os.path.expanduser("~"), ".cache", "agents")
+
+
+def get_cache_key(*args):
+    """
+    hash any json-serializable arguments into a stable key
+    """
+    content = json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache which evicts the least recently used entry
+    max_size : the max number of entries
+    ttl : seconds before an entry expires, None means never
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            created, value = self.data[key]
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time(), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SQLiteCache:
+    """
+    On-disk cache shared by all processes on the machine
+    path : the sqlite file
+    ttl : seconds before an entry expires, None means never
+    dumps & loads : how values are serialized
+    """
+    def __init__(self, path, ttl=None, dumps=json.dumps, loads=json.loads):
+        self.path = path
+        self.ttl = ttl
+        self.dumps = dumps
+        self.loads = loads
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)"
+            )
+            self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl is not None and time.time() - created > self.ttl:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+        return self.loads(value)
+
+    def set(self, key, value):
+        value = self.dumps(value)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self.conn.commit()
+
+    def get_many(self, keys):
+        """
+        Return : dict of the keys found
+        """
+        found = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT key, value, created FROM cache WHERE key IN (%s)" % ",".join("?" * len(batch)), batch
+                ).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = value
+        return {key: self.loads(value) for key, value in found.items()}
+
+    def set_many(self, items):
+        """
+        write many entries in one transaction
+        """
+        now = time.time()
+        rows = [(key, self.dumps(value), now) for key, value in items.items()]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)", rows
+            )
+            self.conn.commit()
+
+    def clear_expired(self):
+        if self.ttl is None:
+            return
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self.conn.commit()
+
+
+class TieredCache:
+    """
+    LRU in front of SQLite, hits on disk are promoted to memory
+    max_size : the max number of entries in memory
+    path : the sqlite file, the disk tier is off if path is empty
+    ttl : seconds before an entry on disk expires
+    """
+    def __init__(self, max_size=1024, path=None, ttl=None, dumps=json.dumps, loads=json.loads):
+        self.memory = LRUCache(max_size, ttl)
+        self.disk = SQLiteCache(path, ttl, dumps, loads) if path else None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk:
+            self.disk.set(key, value)
+
+    def get_many(self, keys):
+        """
+        Return : dict of the keys found in either tier
+        """
+        found = {}
+        for key in keys:
+            value = self.memory.get(key)
+            if value is not None:
+                found[key] = value
+        if self.disk:
+            missing = [key for key in keys if key not in found]
+            on_disk = self.disk.get_many(missing) if missing else {}
+            for key, value in on_disk.items():
+                self.memory.set(key, value)
+            found.update(on_disk)
+        return found
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.memory.set(key, value)
+        if self.disk and items:
+            self.disk.set_many(items)
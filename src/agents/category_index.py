@@ -0,0 +1,121 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+on-disk index of the category catalogs of CategoryRequirementsComponent, built once and memory-mapped on startup.
+An index is a directory:
+    meta.json : {"sources": {path: mtime}, "embed_model": str, "count": int}
+    names.json : {"names": the distinct leaf names, "records": the record of each name}
+    records.bin & records.offsets.npy & records.ids.npy : the distinct records as json, see knowledge_base.TextColumn
+    embeddings.npy : [count, dim] embeddings of the leaf names
+"""
+import argparse
+import json
+import os
+import shutil
+import torch
+import numpy as np
+from utils import flatten_dict, get_embeddings, get_embed_model_name
+from knowledge_base import TextColumn, _save_texts, get_hash
+from vector_index import save_npy
+from cache import get_cache_dir
+
+
+def _get_sources(information_path):
+    return {os.path.abspath(path): os.path.getmtime(path) for path in information_path}
+
+
+def build_category_index(information_path, path):
+    """
+    Args:
+        information_path(list) : the json catalogs, each record has "cat_leaf_name" and "information"
+        path(str) : the directory of the index
+    """
+    records, names, name_records = [], [], {}
+    for toy_path in information_path:
+        with open(toy_path, encoding="utf-8") as json_file:
+            data = json.load(json_file)
+        for d in data:
+            record = dict(d, information=flatten_dict(d["information"]))
+            records.append(json.dumps(record, ensure_ascii=False))
+            # "a/b" is found by "a", "b" and "a/b"
+            leaf_names = d["cat_leaf_name"].split("/") + [d["cat_leaf_name"]] if "/" in d["cat_leaf_name"] else [d["cat_leaf_name"]]
+            for name in leaf_names:
+                # the first record of a name is the one found, as the linear scan did
+                if name not in name_records:
+                    name_records[name] = len(records) - 1
+                    names.append(name)
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    _save_texts(tmp_path, "records", records)
+    with open(os.path.join(tmp_path, "names.json"), "w", encoding="utf-8") as f:
+        json.dump({"names": names, "records": [name_records[name] for name in names]}, f, ensure_ascii=False)
+    save_npy(os.path.join(tmp_path, "embeddings.npy"), get_embeddings(names).numpy().astype(np.float32))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"sources": _get_sources(information_path), "embed_model": get_embed_model_name(), "count": len(names)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+class CategoryIndex:
+    """
+    names(list) : the distinct leaf names
+    embeddings(torch.Tensor) : [len(names), dim] embeddings of the names, memory-mapped copy-on-write
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "names.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        self.names = data["names"]
+        self.name_records = dict(zip(self.names, data["records"]))
+        self.records = TextColumn(path, "records")
+        self.embeddings = torch.from_numpy(np.load(os.path.join(path, "embeddings.npy"), mmap_mode="c"))
+
+    def get(self, name):
+        """
+        Return : the record of the leaf name, None if there is none
+        """
+        if name not in self.name_records:
+            return None
+        return json.loads(self.records[self.name_records[name]])
+
+    def __len__(self):
+        return len(self.names)
+
+
+def get_category_index(information_path):
+    """
+    Load the index of the catalogs, it is built again once a catalog or the embedding model changes.
+    CATEGORY_INDEX_PATH : the directory the indexes are saved in, {CACHE_DIR}/category_index by default
+    """
+    root = os.environ["CATEGORY_INDEX_PATH"] if "CATEGORY_INDEX_PATH" in os.environ else os.path.join(get_cache_dir(), "category_index")
+    path = os.path.join(root, get_hash(*sorted(os.path.abspath(p) for p in information_path))[:16])
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["sources"] == _get_sources(information_path) and meta["embed_model"] == get_embed_model_name():
+            return CategoryIndex(path)
+    os.makedirs(root, exist_ok=True)
+    return CategoryIndex(build_category_index(information_path, path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the category index of the catalogs")
+    parser.add_argument("information_path", nargs="+")
+    args = parser.parse_args()
+    print(f"{len(get_category_index(args.information_path))} categories indexed")
@@ -0,0 +1,227 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+local embedding server shared by the worker processes, reached over a unix socket.
+The requests arriving within a few milliseconds are embedded together in one forward pass.
+    python embedding_server.py --path /tmp/embedding.sock
+and set EMBED_SERVER=/tmp/embedding.sock for the workers, see utils.get_embeddings
+The socket is only accessible to its owner, and the connections are authenticated before anything is unpickled:
+EMBED_SERVER_AUTHKEY sets the key, otherwise the server writes a random one to {path}.key (mode 0600) for its clients.
+"""
+import argparse
+import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from utils import get_embedding_model, get_mock_embedding, get_embed_model_name
+
+
+def get_authkey(path, create=False):
+    """
+    Return : the key of the server at path, from EMBED_SERVER_AUTHKEY or from {path}.key
+    create(bool) : write a new random key to {path}.key if EMBED_SERVER_AUTHKEY is not set
+    """
+    if "EMBED_SERVER_AUTHKEY" in os.environ:
+        return os.environ["EMBED_SERVER_AUTHKEY"].encode("utf-8")
+    key_path = path + ".key"
+    if create:
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(key_path) as f:
+        return f.read().strip().encode("utf-8")
+
+
+class EmbeddingServer:
+    """
+    Args:
+        path(str) : the unix socket
+        max_batch(int) : the max texts of one forward pass
+        max_wait(float) : the seconds a request waits for others to join its batch
+    """
+    def __init__(self, path, max_batch=64, max_wait=0.005):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "batches": 0, "texts": 0, "last_batch_size": 0, "max_batch_size": 0}
+
+    def _embed(self, sentences):
+        if get_embed_model_name() == "mock":
+            embeds = get_mock_embedding(sentences)
+        else:
+            embeds = get_embedding_model().encode(sentences, batch_size=len(sentences), convert_to_tensor=True)
+        return embeds.cpu().numpy().astype(np.float32)
+
+    def _next_batch(self):
+        """
+        Return : the requests of the next batch, waiting max_wait after the first one for the others
+        """
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch, size
+
+    def _run_batches(self):
+        while True:
+            batch, size = self._next_batch()
+            try:
+                embeds = self._embed([sentence for sentences, _ in batch for sentence in sentences])
+            except Exception as e:
+                print(f"failed to embed a batch of {size} texts: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for sentences, future in batch:
+                future.set_result(embeds[start:start + len(sentences)])
+                start += len(sentences)
+            with self.lock:
+                self.stats["requests"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["texts"] += size
+                self.stats["last_batch_size"] = size
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], size)
+
+    def get_stats(self):
+        """
+        Return : {"queue_depth": the requests waiting, "avg_batch_size": the texts per forward pass, ...}
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.requests.qsize()
+        stats["avg_batch_size"] = stats["texts"] / stats["batches"] if stats["batches"] else 0
+        return stats
+
+    def _handle(self, conn):
+        try:
+            while True:
+                op, data = conn.recv()
+                if op == "embed":
+                    future = Future()
+                    self.requests.put((data, future))
+                    try:
+                        conn.send(("ok", future.result()))
+                    except Exception as e:
+                        conn.send(("error", str(e)))
+                elif op == "stats":
+                    conn.send(("ok", self.get_stats()))
+                else:
+                    conn.send(("error", f"unknown op {op}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        authkey = get_authkey(self.path, create=True)
+        # the socket is created with mode 0600
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.path, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+        if get_embed_model_name() != "mock":
+            get_embedding_model()
+        threading.Thread(target=self._run_batches, daemon=True).start()
+        with listener:
+            print(f"embedding server of {get_embed_model_name()} listening on {self.path}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # such as a client with a wrong key
+                    print(f"rejected a connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class EmbeddingClient:
+    """
+    one connection per thread, a connection is not shared between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _request(self, op, data=None):
+        # reconnect once if the server was restarted
+        for retry in range(2):
+            if not hasattr(self.local, "conn"):
+                self.local.conn = Client(self.path, family="AF_UNIX", authkey=get_authkey(self.path))
+            try:
+                self.local.conn.send((op, data))
+                status, result = self.local.conn.recv()
+                break
+            except (EOFError, OSError):
+                del self.local.conn
+                if retry:
+                    raise
+        if status != "ok":
+            raise RuntimeError(f"embedding server: {result}")
+        return result
+
+    def embed(self, sentences):
+        """
+        Return : [len(sentences), dim] embeddings as a numpy array
+        """
+        return self._request("embed", list(sentences))
+
+    def get_stats(self):
+        return self._request("stats")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_embedding_client(path):
+    with _clients_lock:
+        if path not in _clients:
+            _clients[path] = EmbeddingClient(path)
+        return _clients[path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the embedding model over a unix socket")
+    parser.add_argument("--path", type=str, default="/tmp/embedding.sock")
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--max_wait", type=float, default=5, help="milliseconds")
+    parser.add_argument("--stats", action="store_true", help="print the stats of the running server")
+    args = parser.parse_args()
+    if args.stats:
+        print(get_embedding_client(args.path).get_stats())
+    else:
+        EmbeddingServer(args.path, args.max_batch, args.max_wait / 1000).serve_forever()
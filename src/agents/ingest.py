@@ -0,0 +1,260 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+streaming ingestion of documents into a binary knowledge base:
+    discovery -> parsing (process pool) -> chunking -> batched embedding -> append-only writer
+the stages run concurrently and are connected by bounded queues, and the pipeline resumes from its checkpoint
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from langchain.document_loaders import UnstructuredFileLoader
+from langchain.text_splitter import CharacterTextSplitter
+from utils import get_embeddings
+from knowledge_base import append_entries, get_count, tombstone
+
+_DONE = object()
+
+
+def discover_files(paths, extensions=None):
+    """
+    Yield the files under the paths, directories are walked recursively
+    extensions(list) : such as [".pdf", ".txt"], all files if None
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = (
+                os.path.join(root, name)
+                for root, _, names in sorted(os.walk(path))
+                for name in sorted(names)
+            )
+        for file_path in candidates:
+            if not extensions or os.path.splitext(file_path)[1].lower() in extensions:
+                yield file_path
+
+
+def parse_file(file_path):
+    """
+    run in the process pool
+    Return : the text of all the documents in the file
+    """
+    docs = UnstructuredFileLoader(file_path).load()
+    return "\n".join(doc.page_content for doc in docs)
+
+
+class IngestPipeline:
+    """
+    Args:
+        save_path(str) : the binary knowledge base the chunks are appended to
+        workers(int) : the processes parsing the files, all the cores by default
+        chunk_size & chunk_overlap : how the text is split
+        batch_size(int) : the chunks embedded together
+        queue_size(int) : the capacity of the queues between the stages
+    The checkpoint {save_path}/checkpoint.json records the files written (with their mtime, size and entries)
+    and the number of entries at that point, so a rerun skips the unchanged files, replaces the entries of the changed ones
+    and drops what an interrupted run half wrote.
+    """
+    def __init__(self, save_path, workers=None, chunk_size=200, chunk_overlap=100, batch_size=256, queue_size=64, dtype="float32"):
+        self.save_path = save_path
+        self.workers = workers if workers else os.cpu_count()
+        self.splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.dtype = dtype
+        self.checkpoint_path = os.path.join(save_path, "checkpoint.json")
+        self.error = None
+        self.stop = threading.Event()
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return {"files": {}, "count": get_count(self.save_path)}
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        count = get_count(self.save_path)
+        if count > checkpoint["count"]:
+            # written by an interrupted run after its last checkpoint, the files are ingested again
+            tombstone(self.save_path, list(range(checkpoint["count"], count)))
+            checkpoint["count"] = count
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """
+        Return : the next item, _DONE once the pipeline is stopped
+        """
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _run_stage(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            self.error = self.error if self.error else e
+            self.stop.set()
+
+    def _discover(self, paths, extensions, checkpoint, files_q):
+        for file_path in discover_files(paths, extensions):
+            stat = os.stat(file_path)
+            key = os.path.abspath(file_path)
+            if key in checkpoint["files"] and checkpoint["files"][key]["stat"] == [stat.st_mtime, stat.st_size]:
+                continue
+            if not self._put(files_q, (key, [stat.st_mtime, stat.st_size])):
+                return
+        self._put(files_q, _DONE)
+
+    def _parse(self, files_q, texts_q):
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            running = {}
+            finished = False
+            while (not finished or running) and not self.stop.is_set():
+                # keep at most two files per worker in flight
+                while not finished and len(running) < self.workers * 2:
+                    try:
+                        item = files_q.get(timeout=0.1)
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        finished = True
+                        break
+                    running[executor.submit(parse_file, item[0])] = item
+                if not running:
+                    continue
+                done, _ = wait(list(running), timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path, stat = running.pop(future)
+                    try:
+                        text = future.result()
+                    except Exception as e:
+                        print(f"failed to parse {file_path}: {e}")
+                        continue
+                    self._put(texts_q, (file_path, stat, text))
+            if self.stop.is_set():
+                # the files not started yet are dropped, the pool only waits for the running ones
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._put(texts_q, _DONE)
+
+    def _chunk(self, texts_q, chunks_q):
+        while True:
+            item = self._get(texts_q)
+            if item is _DONE:
+                break
+            file_path, stat, text = item
+            self._put(chunks_q, (file_path, stat, self.splitter.split_text(text) if text.strip() else []))
+        self._put(chunks_q, _DONE)
+
+    def _embed(self, chunks_q, embeds_q):
+        files, chunks = [], []
+        finished = False
+        while not finished and not self.stop.is_set():
+            item = self._get(chunks_q)
+            if item is _DONE:
+                finished = True
+            else:
+                files.append(item)
+                chunks += item[2]
+            if chunks and (len(chunks) >= self.batch_size or finished) or (finished and files):
+                embeddings = get_embeddings(chunks).numpy() if chunks else None
+                # the embeddings are handed to the writer file by file, so a checkpoint never splits a file
+                start = 0
+                for file_path, stat, file_chunks in files:
+                    file_embeddings = embeddings[start:start + len(file_chunks)] if file_chunks else None
+                    start += len(file_chunks)
+                    self._put(embeds_q, (file_path, stat, file_chunks, file_embeddings))
+                files, chunks = [], []
+        self._put(embeds_q, _DONE)
+
+    def run(self, paths, extensions=None):
+        """
+        Return : {"knowledge_base": save_path, "type": "UnstructuredFile", "files": files written, "chunks": chunks written}
+        """
+        os.makedirs(self.save_path, exist_ok=True)
+        checkpoint = self._load_checkpoint()
+        files_q, texts_q, chunks_q, embeds_q = (queue.Queue(self.queue_size) for _ in range(4))
+        stages = [
+            threading.Thread(target=self._run_stage, args=(self._discover, paths, extensions, checkpoint, files_q)),
+            threading.Thread(target=self._run_stage, args=(self._parse, files_q, texts_q)),
+            threading.Thread(target=self._run_stage, args=(self._chunk, texts_q, chunks_q)),
+            threading.Thread(target=self._run_stage, args=(self._embed, chunks_q, embeds_q)),
+        ]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        files, chunks = 0, 0
+        try:
+            while True:
+                item = self._get(embeds_q)
+                if item is _DONE:
+                    break
+                file_path, stat, file_chunks, embeddings = item
+                append_entries(
+                    self.save_path, "UnstructuredFile", embeddings, [(c, {"chunk": c}) for c in file_chunks], self.dtype
+                )
+                if file_path in checkpoint["files"]:
+                    # the file has changed, its old entries are replaced
+                    start, end = checkpoint["files"][file_path]["entries"]
+                    tombstone(self.save_path, list(range(start, end)))
+                checkpoint["files"][file_path] = {
+                    "stat": stat,
+                    "entries": [checkpoint["count"], checkpoint["count"] + len(file_chunks)],
+                }
+                checkpoint["count"] += len(file_chunks)
+                self._save_checkpoint(checkpoint)
+                files += 1
+                chunks += len(file_chunks)
+        finally:
+            # the stages stop and the process pool shuts down even if the writer fails
+            self.stop.set()
+            for stage in stages:
+                stage.join()
+        if self.error:
+            raise self.error
+        print(f"ingested {chunks} chunks of {files} files into {self.save_path}")
+        return {"knowledge_base": self.save_path, "type": "UnstructuredFile", "files": files, "chunks": chunks}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ingest the documents under the paths into a binary knowledge base")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--save_path", type=str, required=True)
+    parser.add_argument("--extensions", type=str, nargs="*", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=256)
+    args = parser.parse_args()
+    IngestPipeline(args.save_path, workers=args.workers, batch_size=args.batch_size).run(args.paths, args.extensions)
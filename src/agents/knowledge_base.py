@@ -0,0 +1,502 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+binary knowledge base format, opened through mmap so that loading is instant
+and the worker processes share the pages.
+A knowledge base is a directory:
+    meta.json : {"type": "QA" or "UnstructuredFile", "count": int, "dim": int, "dtype": "float32" or "float16", "fields": [...]}
+    embeddings.npy : [count, dim] normalized embeddings
+    {field}.bin : the distinct texts of the field, utf-8 encoded one after another
+    {field}.offsets.npy : the byte offset of each distinct text, plus the end
+    {field}.ids.npy : the distinct text of each entry, texts repeated across entries (such as the answers) are stored once
+    deleted.npy : the tombstones of the entries removed by update_knowledge_base
+    sources.json : the hash and the entries of every source row, written by update_knowledge_base
+    ivf.npz, bm25.npz, embeddings.{int8,float16}.npy : the indexes, built when they are first used
+The entries are appended in place and meta.json is replaced last, so only the first "count" entries are read,
+and an append interrupted before it is rolled back by the next update.
+The updates of a knowledge base are serialized by the lock file {path}.lock.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+import numpy as np
+from vector_index import normalize, save_npy, append_npy, truncate_npy, QuantizedEmbeddings, IVFIndex, get_index, get_index_path
+from bm25 import BM25Index, get_bm25, get_bm25_path, get_texts
+
+QA_FIELDS = ["q", "a", "chunk"]
+UNSTRUCTURED_FIELDS = ["chunk"]
+
+
+class TextColumn:
+    """
+    Read-only list of strings decoded from the mmap on access
+    count(int) : the entries counted by meta.json, the ones appended after them are not read
+    """
+    def __init__(self, path, field, count=None):
+        self.offsets = np.load(os.path.join(path, f"{field}.offsets.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, f"{field}.ids.npy"), mmap_mode="r")
+        if count is not None:
+            self.ids = self.ids[:count]
+        with open(os.path.join(path, f"{field}.bin"), "rb") as f:
+            # mmap cannot map an empty file
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    def __getitem__(self, idx):
+        text_id = self.ids[idx]
+        return self.data[self.offsets[text_id]:self.offsets[text_id + 1]].decode("utf-8")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def is_binary_knowledge_base(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+
+@contextmanager
+def _lock(path):
+    """
+    hold the lock of the knowledge base against the other threads and processes updating it,
+    the lock file is next to the directory since the directory is replaced by save_knowledge_base
+    """
+    with open(path.rstrip(os.sep) + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _save_json(path, data, indent=None):
+    """
+    write a temporary file which then replaces path, the readers see the old or the new content
+    """
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def _write_texts(f, texts, start_id=0, start_offset=0):
+    """
+    Return : the ids of the texts and the end offsets of the distinct texts written
+    """
+    distinct = {}
+    ids = np.empty(len(texts), dtype=np.int64)
+    offsets = []
+    end = start_offset
+    for i, text in enumerate(texts):
+        if text not in distinct:
+            distinct[text] = start_id + len(distinct)
+            data = str(text).encode("utf-8")
+            f.write(data)
+            end += len(data)
+            offsets.append(end)
+        ids[i] = distinct[text]
+    return ids, np.array(offsets, dtype=np.int64)
+
+
+def _save_texts(path, field, texts):
+    with open(os.path.join(path, f"{field}.bin"), "wb") as f:
+        ids, offsets = _write_texts(f, texts)
+    save_npy(os.path.join(path, f"{field}.offsets.npy"), np.concatenate([[0], offsets]).astype(np.int64))
+    save_npy(os.path.join(path, f"{field}.ids.npy"), ids)
+
+
+def _append_texts(path, field, texts):
+    offsets = np.load(os.path.join(path, f"{field}.offsets.npy"), mmap_mode="r")
+    start_id, start_offset = len(offsets) - 1, int(offsets[-1])
+    with open(os.path.join(path, f"{field}.bin"), "ab") as f:
+        ids, new_offsets = _write_texts(f, texts, start_id, start_offset)
+    append_npy(os.path.join(path, f"{field}.offsets.npy"), new_offsets)
+    append_npy(os.path.join(path, f"{field}.ids.npy"), ids)
+
+
+def save_knowledge_base(path, type, embeddings, fields, dtype="float32"):
+    """
+    Args:
+        path(str) : the directory of the knowledge base
+        type(str) : "QA" or "UnstructuredFile"
+        embeddings : [count, dim] embeddings
+        fields(dict) : key:field name  value:the text of each entry
+        dtype(str) : "float32", or "float16" to halve the size of the embeddings
+    The knowledge base is written to a temporary sibling directory which then replaces the old one,
+    so the processes that have the old files memory-mapped keep reading them intact.
+    Return : the directory of the knowledge base
+    """
+    with _lock(path):
+        return _save_knowledge_base(path, type, embeddings, fields, dtype)
+
+
+def _save_knowledge_base(path, type, embeddings, fields, dtype="float32"):
+    path = path.rstrip(os.sep)
+    final_path, path = path, f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(path)
+    embeddings = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+    save_npy(os.path.join(path, "embeddings.npy"), embeddings.astype(dtype))
+    save_npy(os.path.join(path, "deleted.npy"), np.zeros(len(embeddings), dtype=np.uint8))
+    for field, texts in fields.items():
+        assert len(texts) == len(embeddings), f"{field} has {len(texts)} texts for {len(embeddings)} embeddings"
+        _save_texts(path, field, texts)
+    meta = {
+        "type": type,
+        "count": len(embeddings),
+        "dim": embeddings.shape[1],
+        "dtype": dtype,
+        "fields": list(fields),
+    }
+    BM25Index.build(get_texts(fields)).save(get_bm25_path(path))
+    # meta.json is written last, a directory without it is an unfinished knowledge base
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # the old directory is moved aside before it is removed, its mapped files stay valid until they are unmapped,
+    # and its sources.json and checkpoint.json, which described the old entries, go with it
+    old_path = None
+    if os.path.exists(final_path):
+        old_path = f"{final_path}.old-{uuid.uuid4().hex[:8]}"
+        os.replace(final_path, old_path)
+    os.replace(path, final_path)
+    if old_path:
+        shutil.rmtree(old_path, ignore_errors=True)
+    return final_path
+
+
+def _load_json(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    entries = [data[str(idx)] for idx in range(len(data.keys()))]
+    fields = QA_FIELDS if entries and "q" in entries[0] else UNSTRUCTURED_FIELDS
+    return {
+        "type": "QA" if fields == QA_FIELDS else "UnstructuredFile",
+        "embeddings": normalize(np.atleast_2d(np.array([entry["emb"] for entry in entries], dtype=np.float32))),
+        "fields": {field: [entry[field] for entry in entries] for field in fields},
+        "deleted": None,
+    }
+
+
+def load_knowledge_base(path):
+    """
+    Load a binary or json knowledge base.
+    Return :
+        {"type": str, "embeddings": np.ndarray [count, dim] normalized, float16 if it is stored so,
+         "fields": {field: list-like of str},
+         "deleted": np.ndarray [count] tombstones or None}
+    """
+    if not is_binary_knowledge_base(path):
+        return _load_json(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    # float16 embeddings stay memory-mapped, the search converts the rows it scans block by block,
+    # and the rows of an append in progress after the entries counted by meta.json are left out
+    count = meta["count"]
+    embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")[:count]
+    deleted_path = os.path.join(path, "deleted.npy")
+    deleted = np.load(deleted_path, mmap_mode="r")[:count] if os.path.exists(deleted_path) else None
+    return {
+        "type": meta["type"],
+        "embeddings": embeddings,
+        "fields": {field: TextColumn(path, field, count) for field in meta["fields"]},
+        "deleted": deleted if deleted is not None and deleted.any() else None,
+    }
+
+
+def get_hash(*texts):
+    return hashlib.sha256(json.dumps(texts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _update_derived(path, old_embeddings, embeddings, fields):
+    """
+    bring the quantized embeddings, the IVF index and the BM25 index saved next to the knowledge base up to date in place
+    fields(dict) : the texts of the appended entries
+    """
+    new_embeddings = embeddings[len(old_embeddings):]
+    for dtype in ["int8", "float16"]:
+        quantized_path = os.path.join(path, f"embeddings.{dtype}")
+        if os.path.exists(quantized_path + ".npy"):
+            QuantizedEmbeddings.load(quantized_path).append(quantized_path, new_embeddings)
+    index_path = get_index_path(path)
+    if os.path.exists(index_path):
+        index = IVFIndex.load(index_path, old_embeddings)
+        if index:
+            index.add(embeddings)
+            index.save(index_path)
+        else:
+            os.remove(index_path)
+    bm25_path = get_bm25_path(path)
+    if os.path.exists(bm25_path):
+        BM25Index.load(bm25_path).add(get_texts(fields)).save(bm25_path)
+
+
+def _rollback(path, meta):
+    """
+    drop what an interrupted append wrote after the entries counted by meta.json,
+    the indexes it may have updated are removed and built again by the next reader
+    """
+    count = meta["count"]
+    if not truncate_npy(os.path.join(path, "embeddings.npy"), count):
+        # the embeddings are appended first, nothing else was written
+        return
+    truncate_npy(os.path.join(path, "deleted.npy"), count)
+    for field in meta["fields"]:
+        ids_path = os.path.join(path, f"{field}.ids.npy")
+        truncate_npy(ids_path, count)
+        # the texts are numbered in the order they are written
+        distinct = int(np.load(ids_path, mmap_mode="r").max()) + 1 if count else 0
+        offsets_path = os.path.join(path, f"{field}.offsets.npy")
+        truncate_npy(offsets_path, distinct + 1)
+        with open(os.path.join(path, f"{field}.bin"), "r+b") as f:
+            f.truncate(int(np.load(offsets_path, mmap_mode="r")[distinct]))
+    derived = [os.path.join(path, f"embeddings.{dtype}{suffix}") for dtype in ["int8", "float16"] for suffix in [".npy", ".scales.npy"]]
+    for derived_path in derived + [get_index_path(path), get_bm25_path(path)]:
+        if os.path.exists(derived_path):
+            os.remove(derived_path)
+
+
+def update_knowledge_base(path, type, rows, embed, dtype="float32"):
+    """
+    Incrementally update a binary knowledge base from its source rows:
+    only the entries of the added or changed rows are embedded and appended,
+    the entries of the changed or deleted rows are tombstoned,
+    and the quantized embeddings and the IVF index next to it are updated in place.
+    Args:
+        rows(dict) : key:the id of the source row  value:(hash of the row, entries of the row)
+                     an entry is (the text to embed, {field: text})
+        embed(function) : embed(texts) returns the [len(texts), dim] embeddings
+    Return :
+        {"added": the added entries, "deleted": the tombstoned entries, "unchanged": the unchanged rows}
+    """
+    with _lock(path):
+        return _update_knowledge_base(path, type, rows, embed, dtype)
+
+
+def _update_knowledge_base(path, type, rows, embed, dtype="float32"):
+    fields = QA_FIELDS if type == "QA" else UNSTRUCTURED_FIELDS
+    manifest_path = os.path.join(path, "sources.json")
+    if not is_binary_knowledge_base(path) or not os.path.exists(manifest_path):
+        # build it from scratch, the knowledge bases converted from json do not know their source rows
+        entries, sources = [], {}
+        for key, (row_hash, row_entries) in rows.items():
+            sources[key] = {"hash": row_hash, "entries": list(range(len(entries), len(entries) + len(row_entries)))}
+            entries += row_entries
+        embeddings = embed([text for text, _ in entries])
+        path = _save_knowledge_base(
+            path, type, embeddings, {field: [entry[field] for _, entry in entries] for field in fields}, dtype
+        )
+        _save_json(os.path.join(path, "sources.json"), {"rows": sources, "count": len(entries)})
+        return {"added": len(entries), "deleted": 0, "unchanged": 0}
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    sources = manifest["rows"]
+
+    tombstones = []
+    if "count" in manifest and meta["count"] > manifest["count"]:
+        # appended by an update interrupted before it wrote sources.json, the rows are added again
+        tombstones += list(range(manifest["count"], meta["count"]))
+    for key in list(sources):
+        if key not in rows or rows[key][0] != sources[key]["hash"]:
+            tombstones += sources.pop(key)["entries"]
+    entries = []
+    added_rows = 0
+    for key, (row_hash, row_entries) in rows.items():
+        if key not in sources:
+            added_rows += 1
+            start = meta["count"] + len(entries)
+            sources[key] = {"hash": row_hash, "entries": list(range(start, start + len(row_entries)))}
+            entries += row_entries
+
+    # sources.json is written last, an interrupted update is done again from the old one
+    _append_entries(path, type, embed([text for text, _ in entries]) if entries else None, entries)
+    _tombstone(path, tombstones)
+    _save_json(manifest_path, {"rows": sources, "count": meta["count"] + len(entries)})
+    return {"added": len(entries), "deleted": len(tombstones), "unchanged": len(rows) - added_rows}
+
+
+def get_count(path):
+    """
+    Return : the number of entries of the binary knowledge base, tombstoned ones included, 0 if it does not exist
+    """
+    if not is_binary_knowledge_base(path):
+        return 0
+    with open(os.path.join(path, "meta.json")) as f:
+        return json.load(f)["count"]
+
+
+def append_entries(path, type, embeddings, entries, dtype="float32"):
+    """
+    Append entries to the binary knowledge base in place, it is created if it does not exist.
+    The quantized embeddings and the IVF index next to it are updated.
+    Args:
+        embeddings : [len(entries), dim] embeddings
+        entries(list) : (the embedded text, {field: text})
+    """
+    if not entries:
+        return
+    with _lock(path):
+        _append_entries(path, type, embeddings, entries, dtype)
+
+
+def _append_entries(path, type, embeddings, entries, dtype="float32"):
+    fields = QA_FIELDS if type == "QA" else UNSTRUCTURED_FIELDS
+    if not entries:
+        return
+    if not is_binary_knowledge_base(path):
+        _save_knowledge_base(path, type, embeddings, {field: [entry[field] for _, entry in entries] for field in fields}, dtype)
+        return
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    _rollback(path, meta)
+    old_embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+    embeddings = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+    append_npy(os.path.join(path, "embeddings.npy"), embeddings.astype(meta["dtype"]))
+    append_npy(os.path.join(path, "deleted.npy"), np.zeros(len(entries), dtype=np.uint8))
+    fields = {field: [entry[field] for _, entry in entries] for field in meta["fields"]}
+    for field, texts in fields.items():
+        _append_texts(path, field, texts)
+    _update_derived(path, old_embeddings, np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"), fields)
+    # the entries are visible once meta.json counts them
+    meta["count"] += len(entries)
+    _save_json(os.path.join(path, "meta.json"), meta, indent=2)
+
+
+def tombstone(path, ids):
+    """
+    mark the entries as deleted, they are skipped by the search
+    """
+    if not ids:
+        return
+    with _lock(path):
+        _tombstone(path, ids)
+
+
+def _tombstone(path, ids):
+    if not ids:
+        return
+    deleted = np.load(os.path.join(path, "deleted.npy"), mmap_mode="r+")
+    # the entries tombstoned again by a repeated update are counted once
+    ids = np.asarray(ids, dtype=np.int64)
+    ids = ids[deleted[ids] == 0]
+    deleted[ids] = 1
+    deleted.flush()
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    meta["deleted"] = (meta["deleted"] if "deleted" in meta else 0) + len(ids)
+    _save_json(os.path.join(path, "meta.json"), meta, indent=2)
+
+
+def convert_json_knowledge_base(json_path, path=None, dtype="float32"):
+    """
+    Convert a json knowledge base written by process_document into the binary format
+    Return : the directory of the binary knowledge base, {json_path without .json}.kb by default
+    """
+    path = path if path else os.path.splitext(json_path)[0] + ".kb"
+    knowledge_base = _load_json(json_path)
+    return save_knowledge_base(
+        path, knowledge_base["type"], knowledge_base["embeddings"], knowledge_base["fields"], dtype
+    )
+
+
+class KnowledgeBaseRegistry:
+    """
+    Load every knowledge base once per process and share its read-only embeddings, texts and indexes between the components.
+    The knowledge bases are keyed by their path and modification time, so a knowledge base updated on disk is loaded again
+    while the components holding the old version keep it until they release it.
+    """
+    def __init__(self):
+        self.knowledge_bases = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(path):
+        # meta.json is rewritten by every update of a binary knowledge base, the tombstones included
+        mtime_path = os.path.join(path, "meta.json") if is_binary_knowledge_base(path) else path
+        return os.path.abspath(path), os.path.getmtime(mtime_path)
+
+    def acquire(self, path, index=None):
+        """
+        Args:
+            path(str) : the path of the knowledge base
+            index(dict) : the config of the index, see vector_index.get_index, and "bm25" to build the BM25 index
+        Return :
+            {"key": the key to release it with, "knowledge_base": see load_knowledge_base, "index": the vector index,
+             "bm25": the BM25 index or None}
+        """
+        index = index if index else {}
+        key = self._get_key(path)
+        index_key = json.dumps({k: v for k, v in index.items() if k not in ["bm25", "rrf_k", "min_score"]}, sort_keys=True)
+        with self.lock:
+            if key not in self.knowledge_bases:
+                self.knowledge_bases[key] = {"knowledge_base": load_knowledge_base(path), "indexes": {}, "bm25": None, "refs": 0}
+            entry = self.knowledge_bases[key]
+            knowledge_base = entry["knowledge_base"]
+            if index_key not in entry["indexes"]:
+                entry["indexes"][index_key] = get_index(knowledge_base["embeddings"], path, index, knowledge_base["deleted"])
+            if entry["bm25"] is None and ("bm25" not in index or index["bm25"]):
+                entry["bm25"] = get_bm25(path, knowledge_base["fields"])
+            entry["refs"] += 1
+        return {
+            "key": key,
+            "knowledge_base": knowledge_base,
+            "index": entry["indexes"][index_key],
+            "bm25": entry["bm25"] if "bm25" not in index or index["bm25"] else None,
+        }
+
+    def release(self, key):
+        """
+        the knowledge base is unloaded once no component holds it
+        """
+        with self.lock:
+            if key not in self.knowledge_bases:
+                return
+            self.knowledge_bases[key]["refs"] -= 1
+            if self.knowledge_bases[key]["refs"] <= 0:
+                del self.knowledge_bases[key]
+
+    def __len__(self):
+        return len(self.knowledge_bases)
+
+
+_registry = KnowledgeBaseRegistry()
+
+
+def get_knowledge_base_registry():
+    """
+    Return the process-wide knowledge base registry
+    """
+    return _registry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert json knowledge bases into the binary format")
+    parser.add_argument("json_paths", nargs="+")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+    for json_path in args.json_paths:
+        print(f"{json_path} -> {convert_json_knowledge_base(json_path, dtype=args.dtype)}")
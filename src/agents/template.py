@@ -81,6 +81,9 @@ States = {
 }
 
 
+# "LLM_type" : "OpenAI" ; "Mock": deterministic offline LLM for load testing, its "LLM" can also set "responses","latency","ttft","token_rate"
+# "Embed_Model" : "mock" in "config" gives deterministic offline embeddings, it is read on each embedding so the config takes effect after import
+# "speculative" : true to predict the next state and role once the agent's response has streamed (call sop.speculate(action,environment) before action.process(), or sop.aspeculate(action,environment) before action.aprocess())
 # default finish_state_name is "end_state"
 # "environment_type" : "competive" : different states not share the memory; "cooperative":diffrent states share the memory
 SOP = {
@@ -0,0 +1,164 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""shared pooled HTTP transport for the LLM client, the embedding client and the tools"""
+import asyncio
+import os
+import threading
+import weakref
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_session = None
+_async_sessions = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_transport_config():
+    """
+    HTTP_POOL_CONNECTIONS : the number of hosts whose connections are kept alive
+    HTTP_POOL_MAXSIZE : the max connections to one host, further requests wait for a free one
+    HTTP_TIMEOUT : seconds to wait for the server to respond
+    HTTP_CONNECT_TIMEOUT : seconds to wait for the connection to be established
+    """
+    return {
+        "pool_connections": eval(os.environ["HTTP_POOL_CONNECTIONS"]) if "HTTP_POOL_CONNECTIONS" in os.environ else 10,
+        "pool_maxsize": eval(os.environ["HTTP_POOL_MAXSIZE"]) if "HTTP_POOL_MAXSIZE" in os.environ else 50,
+        "timeout": eval(os.environ["HTTP_TIMEOUT"]) if "HTTP_TIMEOUT" in os.environ else 600,
+        "connect_timeout": eval(os.environ["HTTP_CONNECT_TIMEOUT"]) if "HTTP_CONNECT_TIMEOUT" in os.environ else 10,
+    }
+
+
+def get_proxy():
+    if "PROXY" in os.environ and os.environ["PROXY"]:
+        assert "http:" in os.environ["PROXY"] or "socks" in os.environ["PROXY"],"PROXY error,PROXY must be http or socks"
+        return os.environ["PROXY"]
+    return None
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session which applies the default timeout to every request that does not set one
+    """
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if "timeout" not in kwargs or kwargs["timeout"] is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def build_session():
+    """
+    Return a new session with the pooled adapter, the timeouts and the proxy of the transport config
+    """
+    config = get_transport_config()
+    session = TimeoutSession((config["connect_timeout"], config["timeout"]))
+    adapter = HTTPAdapter(
+        pool_connections=config["pool_connections"],
+        pool_maxsize=config["pool_maxsize"],
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    proxy = get_proxy()
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    return session
+
+
+def get_session():
+    """
+    Return the process-wide session, its keep-alive connection pools are shared by the embedding client and the tools
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = build_session()
+            proxy = get_proxy()
+            if proxy:
+                # the async requests of openai read the proxy from its settings
+                openai.proxy = proxy
+            # openai keeps a session per thread and closes it once it is a few minutes old,
+            # so it is given the factory rather than the shared session, which would be closed under the other threads
+            openai.requestssession = build_session
+    return _session
+
+
+def get_async_session():
+    """
+    Return the aiohttp session of the running event loop, None if aiohttp is not installed.
+    It is closed by aclose_session
+    """
+    if aiohttp is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with _lock:
+        session = _async_sessions.get(loop)
+        if session is None or session.closed:
+            config = get_transport_config()
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=config["pool_connections"] * config["pool_maxsize"],
+                    limit_per_host=config["pool_maxsize"],
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=None, connect=config["connect_timeout"], sock_read=config["timeout"]
+                ),
+            )
+            _async_sessions[loop] = session
+    return session
+
+
+async def aclose_session():
+    """
+    Close the aiohttp session of the running event loop, call it before the loop is closed (e.g. on server shutdown)
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        session = _async_sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def get_openai_kwargs():
+    """
+    Return the per-request arguments of openai, so the global openai settings are not rewritten on every call
+    """
+    get_session()
+    kwargs = {
+        "api_key": os.environ["API_KEY"] if "API_KEY" in os.environ else None,
+        "request_timeout": get_transport_config()["timeout"],
+    }
+    if "API_BASE" in os.environ and os.environ["API_BASE"]:
+        kwargs["api_base"] = os.environ["API_BASE"]
+    return kwargs
+
+
+def set_openai_async_session():
+    """
+    Let openai send the async requests of the current task through the pooled aiohttp session
+    """
+    session = get_async_session()
+    if session is not None:
+        openai.aiosession.set(session)
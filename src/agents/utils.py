@@ -19,7 +19,6 @@ import random
 import json
 import pandas
 import numpy as np
-import requests
 import torch
 from tqdm import tqdm
 from text2vec import semantic_search
@@ -27,37 +26,322 @@ import re
 import datetime
 from langchain.document_loaders import UnstructuredFileLoader
 from langchain.text_splitter import CharacterTextSplitter
-from sentence_transformers import SentenceTransformer
 import string
 import random
 import os
 import openai
+import threading
+import asyncio
+import gc
+import hashlib
+import time
+from transport import get_session, get_openai_kwargs
+from LLM.context import count_tokens
+from cache import TieredCache, get_cache_key, get_cache_dir
+from knowledge_base import load_knowledge_base, save_knowledge_base, update_knowledge_base, get_hash, QA_FIELDS, UNSTRUCTURED_FIELDS
 
-embed_model_name = os.environ["Embed_Model"] if "Embed_Model" in os.environ else "text-embedding-ada-002"
-if embed_model_name in ["text-embedding-ada-002"]:
-    pass
-else:
-    embedding_model = SentenceTransformer(
-                embed_model_name, device=torch.device("cpu")
+_embedding_models = {}
+_embedding_model_lock = threading.Lock()
+
+
+def get_embed_model_name():
+    """
+    Return the Embed_Model of the environment, read on each call since SOP.from_config sets it after utils is imported
+    """
+    return os.environ["Embed_Model"] if "Embed_Model" in os.environ else "text-embedding-ada-002"
+
+
+def get_embedding_model():
+    """
+    Return the SentenceTransformer of Embed_Model, it is loaded on the first use and shared by the whole process
+    """
+    name = get_embed_model_name()
+    if name not in _embedding_models:
+        with _embedding_model_lock:
+            if name not in _embedding_models:
+                # imported here too, loading sentence_transformers alone takes seconds
+                from sentence_transformers import SentenceTransformer
+                _embedding_models[name] = SentenceTransformer(
+                    name, device=torch.device("cpu")
+                )
+    return _embedding_models[name]
+
+
+def warmup(freeze=True):
+    """
+    Load the embedding model and run it once before serving.
+    Call it in the parent of a forking server, so that the workers share the weights copy-on-write
+    freeze(bool) : move the loaded objects out of the garbage collector, so that its passes in the workers
+                   do not write to (and copy) the shared pages
+    """
+    # with EMBED_SERVER the model is loaded by the embedding server only
+    if get_embed_model_name() not in ["text-embedding-ada-002", "mock"] and "EMBED_SERVER" not in os.environ:
+        get_embedding_model().encode(["warmup"], convert_to_tensor=True)
+    if freeze:
+        gc.freeze()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: the first caller runs the function,
+    the others with the same key wait and share its result (or its exception).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+
+        if not is_leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func(*args, **kwargs)
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+        return call["result"]
+
+    async def ado(self, key, func, *args, **kwargs):
+        """
+        async version of do, func is a coroutine function. Calls are coalesced within one event loop.
+        The shared call runs in its own task, so the caller which started it can be cancelled without failing the others.
+        """
+        key = (id(asyncio.get_running_loop()), key)
+        while True:
+            task = self.async_calls.get(key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                self.async_calls[key] = task
+                task.add_done_callback(lambda task, key=key: self._finish(key, task))
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # the shared call itself was cancelled while this caller was not, it is started again
+                if task.cancelled():
+                    continue
+                raise
+
+    def _finish(self, key, task):
+        if self.async_calls.get(key) is task:
+            del self.async_calls[key]
+        # the exception is raised to the callers, or dropped if they have all been cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+single_flight = SingleFlight()
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Return the process-wide cache of embeddings keyed by the model and the hash of the text,
+    None if it is turned off by EMBED_CACHE=0
+    EMBED_CACHE_SIZE : the max number of embeddings kept in memory
+    EMBED_CACHE_PATH : the sqlite file of the disk tier ({CACHE_DIR}/embedding_cache.db by default), empty to keep only the memory tier
+    """
+    global _embedding_cache
+    if "EMBED_CACHE" in os.environ and os.environ["EMBED_CACHE"] == "0":
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = TieredCache(
+                max_size=eval(os.environ["EMBED_CACHE_SIZE"]) if "EMBED_CACHE_SIZE" in os.environ else 10000,
+                path=os.environ["EMBED_CACHE_PATH"] if "EMBED_CACHE_PATH" in os.environ else os.path.join(get_cache_dir(), "embedding_cache.db"),
+                # embeddings are stored as raw float32 bytes
+                dumps=lambda embed: embed.tobytes(),
+                loads=lambda value: np.frombuffer(value, dtype=np.float32).copy(),
             )
+    return _embedding_cache
+
+
+def _get_embedding_key(sentence):
+    return get_cache_key("embedding", get_embed_model_name(), sentence)
+
+
+def _to_numpy(embed):
+    return embed.detach().cpu().numpy().astype(np.float32)
 
-def get_embedding(sentence):
+
+def get_embedding(sentence, cache=True):
+    """
+    embed the sentence, concurrent calls on the same sentence share one upstream call
+    cache(bool) : False for the texts that will not be seen again, such as the partial responses
+    """
+    if isinstance(sentence, list):
+        return get_embeddings(sentence)
+    cache = get_embedding_cache() if cache else None
+    if cache:
+        embed = cache.get(_get_embedding_key(sentence))
+        if embed is not None:
+            return torch.from_numpy(embed).unsqueeze(0)
+    key = json.dumps(["embedding", get_embed_model_name(), sentence], ensure_ascii=False)
+    embed = single_flight.do(key, _get_embedding, sentence)
+    if cache:
+        cache.set(_get_embedding_key(sentence), _to_numpy(embed[0]))
+    return embed
+
+
+def _get_batches(sentences):
+    """
+    split the sentences into batches within the batch limits of the embedding model
+    EMBED_BATCH_SIZE : the max sentences of one batch, 2048 for openai and 64 for SentenceTransformer by default
+    EMBED_BATCH_TOKENS : the max tokens of one openai request
+    """
+    embed_model_name = get_embed_model_name()
     if embed_model_name in ["text-embedding-ada-002"]:
-        openai.api_key = os.environ["API_KEY"]
-        if "PROXY" in os.environ:
-            assert "http:" in os.environ["PROXY"] or "socks" in os.environ["PROXY"],"PROXY error,PROXY must be http or socks"
-            openai.proxy = os.environ["PROXY"]
-        if "API_BASE" in os.environ:
-            openai.api_base = os.environ["API_BASE"]
+        batch_size = eval(os.environ["EMBED_BATCH_SIZE"]) if "EMBED_BATCH_SIZE" in os.environ else 2048
+        batch_tokens = eval(os.environ["EMBED_BATCH_TOKENS"]) if "EMBED_BATCH_TOKENS" in os.environ else 100000
+    else:
+        batch_size = eval(os.environ["EMBED_BATCH_SIZE"]) if "EMBED_BATCH_SIZE" in os.environ else 64
+        batch_tokens = None
+
+    batches = []
+    batch, tokens = [], 0
+    for sentence in sentences:
+        sentence_tokens = count_tokens(sentence, embed_model_name) if batch_tokens else 0
+        if batch and (len(batch) >= batch_size or (batch_tokens and tokens + sentence_tokens > batch_tokens)):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(sentence)
+        tokens += sentence_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_embeddings(sentences):
+    """
+    embed a list of sentences with as few upstream calls as the batch limits allow,
+    the repeated sentences are embedded once
+    EMBED_SERVER : the unix socket of embedding_server.py, the local models are then run by that server
+    Return :
+        embeds(torch.Tensor) : [len(sentences), dim], in the order of the sentences
+    """
+    unique = list(dict.fromkeys(sentences))
+    cache = get_embedding_cache()
+    embeds = {}
+    if cache:
+        keys = {sentence: _get_embedding_key(sentence) for sentence in unique}
+        cached = cache.get_many(list(keys.values()))
+        for sentence in unique:
+            if keys[sentence] in cached:
+                embeds[sentence] = cached[keys[sentence]]
+
+    missing = [sentence for sentence in unique if sentence not in embeds]
+    for batch in _get_batches(missing):
+        new_embeds = {}
+        for sentence, embed in zip(batch, _get_embeddings(batch)):
+            embeds[sentence] = new_embeds[sentence] = _to_numpy(embed)
+        if cache:
+            cache.set_many({keys[sentence]: embed for sentence, embed in new_embeds.items()})
+    if not sentences:
+        return torch.empty((0, get_embedding_dim()), dtype=torch.float32)
+    return torch.from_numpy(np.stack([embeds[sentence] for sentence in sentences]))
+
+
+def get_embedding_dim():
+    """
+    Return the dimension of the embeddings of Embed_Model
+    """
+    embed_model_name = get_embed_model_name()
+    if embed_model_name == "mock":
+        return eval(os.environ["MOCK_EMBED_DIM"]) if "MOCK_EMBED_DIM" in os.environ else 1536
+    elif embed_model_name in ["text-embedding-ada-002"]:
+        return 1536
+    client = _get_embedding_client()
+    if client:
+        return client.embed([""]).shape[1]
+    return get_embedding_model().get_sentence_embedding_dimension()
+
+
+def _get_embedding_client():
+    """
+    Return the client of the embedding server at EMBED_SERVER, None if it is not set or the model is an API
+    """
+    if "EMBED_SERVER" not in os.environ or get_embed_model_name() in ["text-embedding-ada-002"]:
+        return None
+    # imported here, embedding_server imports utils
+    from embedding_server import get_embedding_client
+    return get_embedding_client(os.environ["EMBED_SERVER"])
+
+
+def _get_embeddings(sentences):
+    embed_model_name = get_embed_model_name()
+    client = _get_embedding_client()
+    if client:
+        return torch.from_numpy(client.embed(sentences))
+    elif embed_model_name == "mock":
+        return get_mock_embedding(sentences)
+    elif embed_model_name in ["text-embedding-ada-002"]:
+        embed = openai.Embedding.create(
+            model=embed_model_name,
+            input=sentences,
+            **get_openai_kwargs()
+        )
+        data = sorted(embed["data"], key=lambda x: x["index"])
+        return torch.tensor([x["embedding"] for x in data], dtype=torch.float32)
+    else:
+        return get_embedding_model().encode(sentences, batch_size=len(sentences), convert_to_tensor=True)
+
+
+def get_mock_embedding(sentence):
+    """
+    Deterministic offline embedding for load testing, the same text always gets the same unit vector.
+    MOCK_EMBED_DIM : the dimension of the vectors
+    MOCK_EMBED_LATENCY : the seconds each call takes
+    """
+    dim = eval(os.environ["MOCK_EMBED_DIM"]) if "MOCK_EMBED_DIM" in os.environ else 1536
+    latency = eval(os.environ["MOCK_EMBED_LATENCY"]) if "MOCK_EMBED_LATENCY" in os.environ else 0
+    if latency:
+        time.sleep(latency)
+    sentences = sentence if isinstance(sentence, list) else [sentence]
+    if not sentences:
+        return torch.empty((0, dim), dtype=torch.float32)
+    embeds = []
+    for text in sentences:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        embed = np.random.RandomState(seed).standard_normal(dim).astype(np.float32)
+        embeds.append(embed / np.linalg.norm(embed))
+    embed = torch.from_numpy(np.stack(embeds))
+    return embed if isinstance(sentence, list) else embed.squeeze(0)
+
+
+def _get_embedding(sentence):
+    embed_model_name = get_embed_model_name()
+    client = _get_embedding_client()
+    if client:
+        embed = torch.from_numpy(client.embed([sentence]))
+    elif embed_model_name == "mock":
+        embed = get_mock_embedding(sentence)
+    elif embed_model_name in ["text-embedding-ada-002"]:
         embedding_model = openai.Embedding
         embed = embedding_model.create(
         model=embed_model_name,
-        input=sentence
+        input=sentence,
+        **get_openai_kwargs()
     )
         embed = embed["data"][0]["embedding"]
         embed = torch.tensor(embed,dtype=torch.float32)
     else:
-        embed = embedding_model.encode(sentence,convert_to_tensor=True)
+        embed = get_embedding_model().encode(sentence,convert_to_tensor=True)
     if len(embed.shape)==1:
         embed = embed.unsqueeze(0)
     return embed
@@ -171,13 +455,18 @@ def process_document(file_path):
         save_path: where to save the json file.
     Json format:
         Dict[num,Dict[q:str,a:str,chunk:str,emb:List[float]]
+    KB_FORMAT : "json" (default) saves the json file, "binary" saves the mmap knowledge base directory
+                {save_path without .json}.kb, the documents other than csv are then ingested by ingest.IngestPipeline
+    KB_DTYPE : "float32" (default) or "float16", the dtype of the embeddings in the binary format
     """
     final_dict = {}
     count = 0
+    kb_format = os.environ["KB_FORMAT"] if "KB_FORMAT" in os.environ else "json"
     if file_path.endswith(".csv"):
         dataset = pandas.read_csv(file_path)
         questions = dataset["question"]
         answers = dataset["answer"]
+        texts = []
         # embedding q+chunk
         for q, a in zip(questions, answers):
             for text in cut_sent(a):
@@ -185,7 +474,7 @@ def process_document(file_path):
                 temp_dict["q"] = q
                 temp_dict["a"] = a
                 temp_dict["chunk"] = text
-                temp_dict["emb"] = get_embedding(q + text).tolist()
+                texts.append(q + text)
                 final_dict[count] = temp_dict
                 count += 1
         # embedding chunk
@@ -195,7 +484,7 @@ def process_document(file_path):
                 temp_dict["q"] = q
                 temp_dict["a"] = a
                 temp_dict["chunk"] = text
-                temp_dict["emb"] = get_embedding(text).tolist()
+                texts.append(text)
                 final_dict[count] = temp_dict
                 count += 1
         # embedding q
@@ -204,7 +493,7 @@ def process_document(file_path):
             temp_dict["q"] = q
             temp_dict["a"] = a
             temp_dict["chunk"] = a
-            temp_dict["emb"] = get_embedding(q).tolist()
+            texts.append(q)
             final_dict[count] = temp_dict
             count += 1
         # embedding q+a
@@ -213,7 +502,7 @@ def process_document(file_path):
             temp_dict["q"] = q
             temp_dict["a"] = a
             temp_dict["chunk"] = a
-            temp_dict["emb"] = get_embedding(q + a).tolist()
+            texts.append(q + a)
             final_dict[count] = temp_dict
             count += 1
         # embedding a
@@ -222,9 +511,11 @@ def process_document(file_path):
             temp_dict["q"] = q
             temp_dict["a"] = a
             temp_dict["chunk"] = a
-            temp_dict["emb"] = get_embedding(a).tolist()
+            texts.append(a)
             final_dict[count] = temp_dict
             count += 1
+        # embed all the texts in batches instead of one request per text
+        embeds = get_embeddings(texts)
         print(f"finish updating {len(final_dict)} data!")
         os.makedirs("temp_database", exist_ok=True)
         save_path = os.path.join(
@@ -232,10 +523,15 @@ def process_document(file_path):
             file_path.split("/")[-1].replace("." + file_path.split(".")[1],
                                              ".json"),
         )
+        save_path = _save_document(save_path, "QA", final_dict, embeds, kb_format)
         print(save_path)
-        with open(save_path, "w") as f:
-            json.dump(final_dict, f, ensure_ascii=False, indent=2)
         return {"knowledge_base": save_path, "type": "QA"}
+    elif kb_format == "binary":
+        # imported here since the pipeline embeds through this module
+        from ingest import IngestPipeline
+        save_path = os.path.join("temp_database", os.path.splitext(os.path.basename(file_path))[0] + ".kb")
+        result = IngestPipeline(save_path).run([file_path])
+        return {"knowledge_base": result["knowledge_base"], "type": "UnstructuredFile"}
     else:
         loader = UnstructuredFileLoader(file_path)
         docs = loader.load()
@@ -248,52 +544,119 @@ def process_document(file_path):
             file_path.replace("." + file_path.split(".")[1], ".json"))
         final_dict = {}
         count = 0
+        embeds = get_embeddings(docs)
         for c in tqdm(docs):
             temp_dict = {}
             temp_dict["chunk"] = c
-            temp_dict["emb"] = get_embedding(c).tolist()
             final_dict[count] = temp_dict
             count += 1
         print(f"finish updating {len(final_dict)} data!")
+        save_path = _save_document(save_path, "UnstructuredFile", final_dict, embeds, kb_format)
+        return {"knowledge_base": save_path, "type": "UnstructuredFile"}
+
+
+def _save_document(save_path, type, final_dict, embeds, kb_format="json"):
+    """
+    save the processed document as a knowledge base, see process_document
+    Return : the path of the knowledge base
+    """
+    if kb_format != "binary":
+        for idx, emb in enumerate(embeds.tolist()):
+            final_dict[idx]["emb"] = emb
         with open(save_path, "w") as f:
             json.dump(final_dict, f, ensure_ascii=False, indent=2)
-        return {"knowledge_base": save_path, "type": "UnstructuredFile"}
+        return save_path
+    fields = QA_FIELDS if type == "QA" else UNSTRUCTURED_FIELDS
+    return save_knowledge_base(
+        os.path.splitext(save_path)[0] + ".kb",
+        type,
+        embeds.numpy(),
+        {field: [final_dict[idx][field] for idx in range(len(final_dict))] for field in fields},
+        os.environ["KB_DTYPE"] if "KB_DTYPE" in os.environ else "float32",
+    )
+
+
+def _get_qa_entries(q, a):
+    """
+    the entries of one QA row, the same as those written by process_document
+    Return : list of (the text to embed, {"q", "a", "chunk"})
+    """
+    chunks = cut_sent(a)
+    entries = [(q + text, {"q": q, "a": a, "chunk": text}) for text in chunks]
+    entries += [(text, {"q": q, "a": a, "chunk": text}) for text in chunks]
+    entries += [(text, {"q": q, "a": a, "chunk": a}) for text in [q, q + a, a]]
+    return entries
+
+
+def _get_document_rows(file_path):
+    """
+    split the document into source rows keyed by their identity: the question of a QA row, the content of a chunk
+    Return : type(str), rows(dict) key:row id  value:(hash of the row, entries of the row)
+    """
+    rows = {}
+    if file_path.endswith(".csv"):
+        dataset = pandas.read_csv(file_path)
+        for q, a in zip(dataset["question"], dataset["answer"]):
+            key = q
+            # a repeated question is a separate row
+            while key in rows:
+                key += "#"
+            rows[key] = (get_hash(q, a), _get_qa_entries(q, a))
+        return "QA", rows
+    loader = UnstructuredFileLoader(file_path)
+    docs = loader.load()
+    text_spiltter = CharacterTextSplitter(chunk_size=200, chunk_overlap=100)
+    for c in text_spiltter.split_text(docs[0].page_content):
+        key = get_hash(c)
+        while key in rows:
+            key += "#"
+        rows[key] = (get_hash(c), [(c, {"chunk": c})])
+    return "UnstructuredFile", rows
+
+
+def ingest_document(file_path, save_path=None):
+    """
+    Incrementally update the binary knowledge base of the document: only the added or changed
+    rows are embedded, the entries of the changed or deleted rows are tombstoned.
+    The first call builds the knowledge base like process_document.
+    Args:
+        save_path : the knowledge base directory, temp_database/{file name}.kb by default
+    Return :
+        {"knowledge_base": path, "type": "QA" or "UnstructuredFile", "added", "deleted", "unchanged"}
+    """
+    if not save_path:
+        os.makedirs("temp_database", exist_ok=True)
+        save_path = os.path.join("temp_database", os.path.splitext(os.path.basename(file_path))[0] + ".kb")
+    type, rows = _get_document_rows(file_path)
+    stats = update_knowledge_base(
+        save_path,
+        type,
+        rows,
+        lambda texts: get_embeddings(texts).numpy(),
+        os.environ["KB_DTYPE"] if "KB_DTYPE" in os.environ else "float32",
+    )
+    print(f"{save_path}: {stats}")
+    return dict({"knowledge_base": save_path, "type": type}, **stats)
+
 
 def load_knowledge_base_qa(path):
     """
-    Load json format knowledge base.
+    Load json or binary format knowledge base.
     """
     print("path", path)
-    with open(path, "r") as f:
-        data = json.load(f)
-    embeddings = []
-    questions = []
-    answers = []
-    chunks = []
-    for idx in range(len(data.keys())):
-        embeddings.append(data[str(idx)]["emb"])
-        questions.append(data[str(idx)]["q"])
-        answers.append(data[str(idx)]["a"])
-        chunks.append(data[str(idx)]["chunk"])
-    embeddings = np.array(embeddings, dtype=np.float32)
-    embeddings = torch.from_numpy(embeddings).squeeze()
-    return embeddings, questions, answers, chunks
+    knowledge_base = load_knowledge_base(path)
+    fields = knowledge_base["fields"]
+    embeddings = torch.from_numpy(np.array(knowledge_base["embeddings"])).squeeze()
+    return embeddings, list(fields["q"]), list(fields["a"]), list(fields["chunk"])
 
 
 def load_knowledge_base_UnstructuredFile(path):
     """
-    Load json format knowledge base.
+    Load json or binary format knowledge base.
     """
-    with open(path, "r") as f:
-        data = json.load(f)
-    embeddings = []
-    chunks = []
-    for idx in range(len(data.keys())):
-        embeddings.append(data[str(idx)]["emb"])
-        chunks.append(data[str(idx)]["chunk"])
-    embeddings = np.array(embeddings, dtype=np.float32)
-    embeddings = torch.from_numpy(embeddings).squeeze()
-    return embeddings, chunks
+    knowledge_base = load_knowledge_base(path)
+    embeddings = torch.from_numpy(np.array(knowledge_base["embeddings"])).squeeze()
+    return embeddings, list(knowledge_base["fields"]["chunk"])
 
 
 def cos_sim(a: torch.Tensor, b: torch.Tensor):
@@ -341,13 +704,16 @@ def matching_category(inputtext,
     """
 
     sim_scores = torch.zeros([100])
+    requirements = requirements.split(" ") if requirements else []
+    # embed the input and the requirements in one batch
+    texts = ([inputtext] if inputtext else []) + requirements
+    embeds = get_embeddings(texts) if texts else None
     if inputtext:
-        input_embeder = get_embedding(inputtext)
+        input_embeder = embeds[:1]
         sim_scores = cos_sim(input_embeder, cat_embedder)[0]
 
     if requirements:
-        requirements = requirements.split(" ")
-        requirements_embedder = get_embedding(requirements)
+        requirements_embedder = embeds[len(texts) - len(requirements):]
         req_scores = cos_sim(requirements_embedder, cat_embedder)
         req_scores = torch.mean(req_scores, dim=0)
         total_scores = req_scores
@@ -412,7 +778,7 @@ def Search_Engines(req):
 
     new_dict = {"keyword": req, "catLeafName": "", "fetchSize": FETSIZE}
     url = os.environ["SHOPPING_SEARCH"]
-    res = requests.post(
+    res = get_session().post(
         url= url,
         json=new_dict,
     )
@@ -454,7 +820,7 @@ def search_with_api(requirements, categery):
 
 
 
-def get_relevant_history(query,history,embeddings):
+def get_relevant_history(query,history,embeddings,query_embedding=None):
     """
     Retrieve a list of key history entries based on a query using semantic search.
 
@@ -462,13 +828,15 @@ def get_relevant_history(query,history,embeddings):
         query (str): The input query for which key history is to be retrieved.
         history (list): A list of historical key entries.
         embeddings (numpy.ndarray): An array of embedding vectors for historical entries.
+        query_embedding (torch.Tensor): The embedding of the query if it is already known.
 
     Returns:
         list: A list of key history entries most similar to the query.
     """
     TOP_K = eval(os.environ["TOP_K"]) if "TOP_K" in os.environ else 2
     relevant_history = []
-    query_embedding = get_embedding(query)
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
     hits = semantic_search(query_embedding, embeddings, top_k=min(TOP_K,embeddings.shape[0]))
     hits = hits[0]
     for hit in hits:
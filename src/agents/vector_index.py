@@ -0,0 +1,467 @@
+# coding=utf-8
+# Copyright 2023  The AIWaves Inc. team.
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""cosine similarity search over the embeddings of a knowledge base, exact or with an IVF index"""
+import os
+import struct
+import threading
+import numpy as np
+
+# the .npy files written here reserve a fixed header, so that rows can be appended in place by rewriting the shape
+NPY_HEADER_SIZE = 128
+NPY_BATCH_ROWS = 65536
+
+
+def _npy_header(shape, dtype):
+    header = repr({
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "fortran_order": False,
+        "shape": tuple(shape),
+    }).encode("latin1")
+    prefix = b"\x93NUMPY\x01\x00"
+    length = NPY_HEADER_SIZE - len(prefix) - 2
+    return prefix + struct.pack("<H", length) + header.ljust(length - 1) + b"\n"
+
+
+def save_npy(path, array):
+    """
+    np.save which leaves room in the header for append_npy, np.load reads the file as usual
+    """
+    with open(path, "wb") as f:
+        f.write(_npy_header(array.shape, array.dtype))
+        for i in range(0, len(array), NPY_BATCH_ROWS):
+            f.write(np.ascontiguousarray(array[i:i + NPY_BATCH_ROWS]).tobytes())
+
+
+def _read_npy_header(path):
+    with open(path, "rb") as f:
+        np.lib.format.read_magic(f)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        return shape, dtype, f.tell()
+
+
+def append_npy(path, rows):
+    """
+    append rows to a .npy file in place, the mappings opened before keep seeing the old rows.
+    The rows are written after the ones in the header and the shape last,
+    so the bytes left by an interrupted append are overwritten.
+    """
+    shape, dtype, header_size = _read_npy_header(path)
+    rows = np.asarray(rows, dtype=dtype).reshape((-1,) + tuple(shape[1:]))
+    if header_size != NPY_HEADER_SIZE:
+        # written by np.save, rewrite it once in the appendable layout
+        save_npy(path, np.concatenate([np.load(path), rows]))
+        return
+    with open(path, "r+b") as f:
+        f.seek(header_size + shape[0] * int(np.prod(shape[1:])) * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.truncate()
+        f.seek(0)
+        f.write(_npy_header((shape[0] + len(rows),) + tuple(shape[1:]), dtype))
+
+
+def truncate_npy(path, count):
+    """
+    keep the first count rows of a .npy file
+    Return : whether anything was dropped
+    """
+    shape, dtype, header_size = _read_npy_header(path)
+    size = header_size + count * int(np.prod(shape[1:])) * dtype.itemsize
+    if shape[0] == count and os.path.getsize(path) == size:
+        return False
+    if header_size != NPY_HEADER_SIZE:
+        save_npy(path, np.array(np.load(path, mmap_mode="r")[:count]))
+        return True
+    with open(path, "r+b") as f:
+        f.truncate(size)
+        f.seek(0)
+        f.write(_npy_header((count,) + tuple(shape[1:]), dtype))
+    return True
+
+
+def save_npz(path, **arrays):
+    """
+    np.savez to a temporary file which then replaces path, so a reader never loads a partly written file
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def normalize(embeddings):
+    """
+    Return : the rows scaled to unit length as float32, so that the dot product is the cosine similarity
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def _best(scores, top_k):
+    """
+    Return : the positions of the top_k highest scores, from the highest
+    """
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    return best[np.argsort(-scores[best])]
+
+
+def _top_k(scores, ids, top_k):
+    """
+    Return : hits(list) : [{"corpus_id": int, "score": float}] sorted by the score, like text2vec.semantic_search
+    """
+    return [
+        {"corpus_id": int(ids[i]), "score": float(scores[i])} for i in _best(scores, top_k) if scores[i] > -np.inf
+    ]
+
+
+class QuantizedEmbeddings:
+    """
+    Compact copy of the embeddings for a fast approximate pass:
+    "int8" keeps one byte per dimension and a scale per row (4x smaller, scanned as fast as float32),
+    "float16" two bytes per dimension (2x smaller, scanned slower since numpy converts it slowly)
+    """
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def build(cls, embeddings, dtype="int8", batch_size=65536):
+        if dtype == "float16":
+            return cls(np.asarray(embeddings, dtype=np.float16))
+        assert dtype == "int8", f"unknown quantization {dtype}"
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        scales = np.empty(len(embeddings), dtype=np.float32)
+        for i in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[i:i + batch_size], dtype=np.float32)
+            batch_scales = np.abs(batch).max(axis=1) / 127
+            batch_scales[batch_scales == 0] = 1
+            codes[i:i + batch_size] = np.round(batch / batch_scales[:, None])
+            scales[i:i + batch_size] = batch_scales
+        return cls(codes, scales)
+
+    def scores(self, query, ids=None, batch_size=1024):
+        """
+        Return : the approximate dot products of the query with the rows (all of them or the ids),
+        the rows are converted in small batches which stay in the cpu cache
+        """
+        codes = self.codes if ids is None else self.codes[ids]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), batch_size):
+            scores[i:i + batch_size] = codes[i:i + batch_size].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales if ids is None else self.scales[ids]
+        return scores
+
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def save(self, path):
+        """
+        save the codes (and the scales) as {path}.npy ({path}.scales.npy),
+        each file is written aside and then replaces the old one, which the readers may have memory-mapped
+        """
+        arrays = {".npy": self.codes}
+        if self.scales is not None:
+            arrays[".scales.npy"] = self.scales
+        for suffix, array in arrays.items():
+            tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}{suffix}"
+            save_npy(tmp_path, array)
+            os.replace(tmp_path, path + suffix)
+
+    def append(self, path, embeddings):
+        """
+        quantize the new embeddings and append them to the files saved at path
+        """
+        quantized = QuantizedEmbeddings.build(embeddings, "float16" if self.scales is None else "int8")
+        append_npy(path + ".npy", quantized.codes)
+        if self.scales is not None:
+            append_npy(path + ".scales.npy", quantized.scales)
+
+    @classmethod
+    def load(cls, path):
+        codes = np.load(path + ".npy", mmap_mode="r")
+        scales = np.load(path + ".scales.npy", mmap_mode="r") if os.path.exists(path + ".scales.npy") else None
+        return cls(codes, scales)
+
+
+def _dot(embeddings, query, batch_size=1024):
+    """
+    Return : the dot products of the query with the rows,
+    float16 rows are converted block by block so that a memory-mapped file is never copied whole
+    """
+    if embeddings.dtype == np.float32:
+        return embeddings @ query
+    scores = np.empty(len(embeddings), dtype=np.float32)
+    for i in range(0, len(embeddings), batch_size):
+        scores[i:i + batch_size] = embeddings[i:i + batch_size].astype(np.float32) @ query
+    return scores
+
+
+def _scan(embeddings, quantized, query, top_k, ids=None, rescore=4, deleted=None):
+    """
+    Score the embeddings (all of them or the ids) against the query.
+    With quantized embeddings, the approximate pass keeps top_k * rescore candidates
+    which are rescored with the full precision embeddings.
+    deleted(np.ndarray) : the tombstones of the rows, the deleted rows are skipped
+    """
+    if quantized is None:
+        scores = _dot(embeddings if ids is None else embeddings[ids], query)
+    else:
+        scores = quantized.scores(query, ids)
+    if deleted is not None:
+        scores[np.asarray(deleted if ids is None else deleted[ids], dtype=bool)] = -np.inf
+    if quantized is None:
+        return _top_k(scores, np.arange(len(scores)) if ids is None else ids, top_k)
+    candidates = _best(scores, top_k * rescore)
+    candidates = candidates[scores[candidates] > -np.inf]
+    candidates = np.sort(candidates if ids is None else ids[candidates])
+    # only the pages of the candidates are read when the embeddings are memory-mapped
+    return _top_k(_dot(embeddings[candidates], query), candidates, top_k)
+
+
+class ExactIndex:
+    """
+    Brute-force scan over all the embeddings
+    quantized(QuantizedEmbeddings) : scan the quantized embeddings and rescore the best candidates
+    rescore(int) : the candidates rescored per result
+    deleted(np.ndarray) : the tombstones of the rows
+    """
+    def __init__(self, embeddings, quantized=None, rescore=4, deleted=None):
+        self.embeddings = embeddings
+        self.quantized = quantized
+        self.rescore = rescore
+        self.deleted = deleted
+
+    def search(self, query, top_k):
+        query = normalize(query).reshape(-1)
+        return _scan(self.embeddings, self.quantized, query, top_k, rescore=self.rescore, deleted=self.deleted)
+
+
+class IVFIndex:
+    """
+    Inverted file index: the embeddings are clustered by spherical k-means,
+    a query only scans the nprobe clusters whose centroids are the closest to it.
+    Raising nprobe improves the recall and costs latency.
+    embeddings(np.ndarray) : [n, dim] normalized embeddings (float32 or float16), kept by reference
+    nlist(int) : the number of clusters, 4 * sqrt(n) by default
+    nprobe(int) : the number of clusters scanned per query
+    """
+    def __init__(self, embeddings, nlist=None, nprobe=8, train_iters=10, seed=0, quantized=None, rescore=4, deleted=None):
+        self.embeddings = embeddings
+        self.quantized = quantized
+        self.rescore = rescore
+        self.deleted = deleted
+        self.nlist = nlist if nlist else max(1, int(4 * np.sqrt(len(embeddings))))
+        self.nprobe = nprobe
+        self.train_iters = train_iters
+        self.seed = seed
+        self.centroids = None
+        # ids of the embeddings grouped by cluster, the ids of cluster i are order[offsets[i]:offsets[i + 1]]
+        self.order = None
+        self.offsets = None
+
+    def _assign(self, embeddings, batch_size=65536):
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for i in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[i:i + batch_size], dtype=np.float32)
+            assignments[i:i + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return assignments
+
+    def build(self):
+        rng = np.random.RandomState(self.seed)
+        n = len(self.embeddings)
+        self.nlist = min(self.nlist, n)
+        # train on a sample, 64 points per cluster are enough for the centroids
+        sample = np.asarray(self.embeddings[rng.choice(n, min(n, self.nlist * 64), replace=False)], dtype=np.float32)
+        self.centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(self.train_iters):
+            assignments = self._assign(sample)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=self.nlist)
+            empty = counts == 0
+            sums = np.zeros_like(self.centroids)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+            # an empty cluster restarts from a random point
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            self.centroids = normalize(sums)
+
+        self._set_lists(self._assign(self.embeddings))
+        return self
+
+    def _set_lists(self, assignments):
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.nlist))])
+
+    def add(self, embeddings):
+        """
+        Index the rows appended to the embeddings in place, the centroids are kept
+        embeddings(np.ndarray) : the old rows followed by the new ones
+        """
+        assignments = np.empty(len(self.order), dtype=np.int64)
+        assignments[self.order] = np.repeat(np.arange(self.nlist), np.diff(self.offsets))
+        new_assignments = self._assign(np.asarray(embeddings[len(self.order):], dtype=np.float32))
+        self.embeddings = embeddings
+        self._set_lists(np.concatenate([assignments, new_assignments]))
+
+    def search(self, query, top_k, nprobe=None):
+        nprobe = min(nprobe if nprobe else self.nprobe, self.nlist)
+        query = normalize(query).reshape(-1)
+        clusters = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+        return _scan(self.embeddings, self.quantized, query, top_k, ids, self.rescore, self.deleted)
+
+    def save(self, path):
+        save_npz(path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 size=len(self.embeddings), nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path, embeddings):
+        """
+        Return : the index saved at path, None if it was built for other embeddings
+        """
+        data = np.load(path)
+        if int(data["size"]) < len(embeddings) or data["centroids"].shape[1] != embeddings.shape[1]:
+            return None
+        index = cls(embeddings, nlist=len(data["centroids"]), nprobe=int(data["nprobe"]))
+        index.centroids, index.order, index.offsets = data["centroids"], data["order"], data["offsets"]
+        if int(data["size"]) > len(embeddings):
+            # saved by an append in progress, the entries meta.json does not count yet are left out
+            lists = np.repeat(np.arange(index.nlist), np.diff(index.offsets))
+            keep = index.order < len(embeddings)
+            index.order = index.order[keep]
+            index.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists[keep], minlength=index.nlist))])
+        return index
+
+
+def maximal_marginal_relevance(embeddings, relevance, top_k, lambda_mult=0.7, costs=None, budget=None):
+    """
+    Select the candidates that are relevant and unlike the ones already selected.
+    Args:
+        embeddings(np.ndarray) : [n, dim] normalized embeddings of the candidates
+        relevance(np.ndarray) : [n] relevance of the candidates to the query
+        lambda_mult(float) : 1 ranks by relevance only, 0 by diversity only
+        costs & budget : the candidates are selected while the sum of their costs (such as tokens) fits in the budget,
+                         the most relevant one is always selected
+    Return : the positions of the selected candidates, in the order they are selected
+    """
+    embeddings = normalize(embeddings)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    similarity = embeddings @ embeddings.T
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    costs = np.asarray(costs) if costs is not None else None
+    remaining = budget
+    selected = []
+    while len(selected) < top_k and available.any():
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * max_similarity, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+        if budget is not None:
+            remaining -= costs[best]
+            available &= costs <= remaining
+    return selected
+
+
+def _get_mtime(knowledge_base):
+    """
+    the files derived from a binary knowledge base are saved in its directory, so its embeddings are compared instead
+    """
+    if os.path.isdir(knowledge_base):
+        return os.path.getmtime(os.path.join(knowledge_base, "embeddings.npy"))
+    return os.path.getmtime(knowledge_base)
+
+
+def get_index_path(knowledge_base):
+    """
+    the IVF index of a binary knowledge base is saved in its directory, so it is replaced along with it
+    """
+    if os.path.isdir(knowledge_base):
+        return os.path.join(knowledge_base, "ivf.npz")
+    return os.path.normpath(knowledge_base) + ".ivf.npz"
+
+
+def get_quantized(embeddings, knowledge_base=None, dtype="int8"):
+    """
+    Return the quantized embeddings of the knowledge base.
+    For a binary knowledge base they are saved in its directory and memory-mapped, so that only
+    the compact copy stays in memory while the full precision embeddings are read for rescoring.
+    """
+    path = os.path.join(knowledge_base, f"embeddings.{dtype}") if knowledge_base and os.path.isdir(knowledge_base) else None
+    if path and os.path.exists(path + ".npy") and os.path.getmtime(path + ".npy") >= _get_mtime(knowledge_base):
+        quantized = QuantizedEmbeddings.load(path)
+        # an append in progress writes the quantized embeddings before meta.json counts the new entries
+        if quantized.codes.shape[0] >= len(embeddings) and quantized.codes.shape[1:] == embeddings.shape[1:]:
+            if quantized.codes.shape[0] > len(embeddings):
+                quantized.codes = quantized.codes[:len(embeddings)]
+                quantized.scales = quantized.scales[:len(embeddings)] if quantized.scales is not None else None
+            return quantized
+    quantized = QuantizedEmbeddings.build(embeddings, dtype)
+    if path:
+        try:
+            quantized.save(path)
+            return QuantizedEmbeddings.load(path)
+        except OSError as e:
+            print(f"failed to save the quantized embeddings of {knowledge_base}: {e}")
+    return quantized
+
+
+def get_index(embeddings, knowledge_base=None, config=None, deleted=None):
+    """
+    Build the index of the knowledge base, or load it from next to the knowledge base if it is up to date.
+    Args:
+        embeddings(np.ndarray) : [n, dim] normalized embeddings
+        knowledge_base(str) : the path of the knowledge base, the IVF index is saved next to it, see get_index_path
+        config(dict) : "type" : "exact", "ivf" or "auto" (ivf once the knowledge base has "min_size" embeddings, 10000 by default)
+                       "nlist" & "nprobe" : the parameters of the IVF index
+                       "quantization" : "int8" or "float16" to scan quantized embeddings, "rescore" : the candidates rescored per result
+        deleted(np.ndarray) : the tombstones of the rows, the deleted rows are never returned
+    Return :
+        index(ExactIndex or IVFIndex)
+    """
+    config = config if config else {}
+    index_type = config["type"] if "type" in config else "auto"
+    min_size = config["min_size"] if "min_size" in config else 10000
+    rescore = config["rescore"] if "rescore" in config else 4
+    quantized = None
+    if "quantization" in config and config["quantization"] and len(embeddings) > 0:
+        quantized = get_quantized(embeddings, knowledge_base, config["quantization"])
+    if index_type == "exact" or (index_type == "auto" and len(embeddings) < min_size) or len(embeddings) == 0:
+        return ExactIndex(embeddings, quantized, rescore, deleted)
+
+    nprobe = config["nprobe"] if "nprobe" in config else 8
+    path = get_index_path(knowledge_base) if knowledge_base else None
+    if path and os.path.exists(path) and os.path.getmtime(path) >= _get_mtime(knowledge_base):
+        index = IVFIndex.load(path, embeddings)
+        if index and ("nlist" not in config or config["nlist"] == index.nlist):
+            index.nprobe = nprobe
+            index.quantized, index.rescore, index.deleted = quantized, rescore, deleted
+            return index
+
+    index = IVFIndex(embeddings, config["nlist"] if "nlist" in config else None, nprobe,
+                     quantized=quantized, rescore=rescore, deleted=deleted).build()
+    if path:
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"failed to save the index of {knowledge_base}: {e}")
+    return index